@@ -62,6 +62,8 @@ install -m 644 targetd.yaml.5 %{buildroot}%{_mandir}/man5/
 %{__install} -m 0755 utils/filesys_list.py          $RPM_BUILD_ROOT%{_bindir}/filesys_list
 %{__install} -m 0755 utils/initiator_list.py        $RPM_BUILD_ROOT%{_bindir}/initiator_list
 %{__install} -m 0755 utils/pool_list.py             $RPM_BUILD_ROOT%{_bindir}/pool_list
+# The HTTP transport the utilities share
+%{__install} -m 0644 utils/targetd_rpc.py           $RPM_BUILD_ROOT%{python3_sitelib}/targetd_rpc.py
 
 %post
 %systemd_post targetd.service
@@ -84,6 +86,8 @@ install -m 644 targetd.yaml.5 %{buildroot}%{_mandir}/man5/
 %{_bindir}/filesys_list
 %{_bindir}/initiator_list
 %{_bindir}/pool_list
+%{python3_sitelib}/targetd_rpc.py
+%{python3_sitelib}/__pycache__/targetd_rpc.*
 
 %files
 %{_bindir}/targetd
@@ -0,0 +1,313 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# asyncio front end for the jsonrpc API.
+#
+# A single event loop accepts and parses every (keep-alive) connection, the
+# RPC methods themselves run on a bounded pool of worker threads.  While the
+# loop is running, commands started through utils.invoke() from those workers
+# are spawned and reaped by the loop too.
+
+import asyncio
+import concurrent.futures
+import ssl
+import threading
+import logging as log
+from concurrent.futures import ThreadPoolExecutor
+
+from targetd import metrics, utils
+from targetd.main import check_auth, rpc_stream, ssl_context
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    411: "Length Required",
+    500: "Internal Server Error",
+    501: "Not Implemented",
+}
+
+
+class AsyncService(object):
+    """
+    Serve /targetrpc from an asyncio event loop
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.timeout = config['keepalive_timeout']
+        self.executor = ThreadPoolExecutor(max_workers=config['max_workers'])
+
+    async def _readline(self, reader):
+        return await asyncio.wait_for(reader.readline(), self.timeout)
+
+    async def _read_request(self, reader):
+        """
+        Returns (method, path, version, headers) or None on a closed
+        connection, raises ValueError on a malformed request.
+        """
+        line = await self._readline(reader)
+        if not line:
+            return None
+
+        method, path, version = line.decode('latin-1').split()
+
+        headers = {}
+        while True:
+            line = await self._readline(reader)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        return method, path, version, headers
+
+    @staticmethod
+    def _keep_alive(version, headers):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    @staticmethod
+    def _write_head(writer, code, length, keep_alive,
+                    content_type="application/json", chunked=True):
+        # Without a length the body is chunked, or ends when the connection
+        # is closed (keep_alive must be false)
+        head = ["HTTP/1.1 %d %s" % (code, _REASONS.get(code, ""))]
+        if length is not None:
+            head.append("Content-Length: %d" % length)
+        elif chunked:
+            head.append("Transfer-Encoding: chunked")
+        if code == 200:
+            head.append("Content-Type: %s" % content_type)
+        if not keep_alive:
+            head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+
+    def _write(self, writer, code, body, keep_alive,
+               content_type="application/json"):
+        self._write_head(writer, code, len(body), keep_alive, content_type)
+        writer.write(body)
+
+    async def _drain(self, writer):
+        """
+        Wait for the client to take what was written.  Returns False, the
+        connection dropped, when it doesn't within the timeout: a client
+        that stops reading must not keep the locks of its call.
+        """
+        try:
+            await asyncio.wait_for(writer.drain(), self.timeout)
+        except asyncio.TimeoutError:
+            writer.transport.abort()
+            return False
+        return True
+
+    @staticmethod
+    def _produce(loop, stream, chunks, cancelled):
+        """
+        Run the whole of rpc_stream() on one worker thread, handing its
+        chunks to the loop through the chunks queue: what a batch defers per
+        thread (LIO saves) and the resource locks of the call must be
+        entered and left on the same thread.  An exception raised is passed
+        on instead of a chunk, None ends.
+        """
+        def put(item):
+            """
+            False when the loop is shutting down and nobody takes item
+            """
+            try:
+                utils.run_in_loop(chunks.put(item))
+                return True
+            except concurrent.futures.CancelledError:
+                return False
+
+        try:
+            for chunk in stream:
+                if not put(chunk) or cancelled.is_set():
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            # Releases the locks of an unfinished response, may have to
+            # save the LIO configuration at the end of a batch
+            stream.close()
+            put(None)
+
+    async def _send(self, writer, chunks, keep_alive, chunked):
+        """
+        Send the response chunks, returns False when the response could not
+        be sent in full
+        """
+        first = await chunks.get()
+        second = None
+        if first is not None and not isinstance(first, Exception):
+            second = await chunks.get()
+        if isinstance(first, Exception) or isinstance(second, Exception):
+            self._write(writer, 500, b'', False)
+            return False
+
+        if second is None:
+            self._write(writer, 200, first or b'', keep_alive)
+            return True
+
+        self._write_head(writer, 200, None, keep_alive and chunked,
+                         chunked=chunked)
+        chunk = first
+        while chunk is not None:
+            if chunked:
+                chunk = b"%x\r\n%s\r\n" % (len(chunk), chunk)
+            writer.write(chunk)
+            # don't produce faster than the client reads
+            if not await self._drain(writer):
+                return False
+            if second is not None:
+                chunk, second = second, None
+            else:
+                chunk = await chunks.get()
+                if isinstance(chunk, Exception):
+                    # logged by rpc_stream(), leave the body unterminated
+                    return False
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+        # an HTTP/1.0 client sees the end when the connection is closed
+        return chunked
+
+    async def _stream(self, writer, stream, keep_alive, chunked):
+        """
+        Send the response of rpc_stream(), the methods and the encoding run
+        on a worker thread.  Returns False when the response could not be
+        sent in full or the connection must be closed to end it.
+        """
+        loop = asyncio.get_event_loop()
+        chunks = asyncio.Queue(maxsize=1)
+        cancelled = threading.Event()
+        producer = loop.run_in_executor(self.executor, self._produce, loop,
+                                        stream, chunks, cancelled)
+        try:
+            return await self._send(writer, chunks, keep_alive, chunked)
+        finally:
+            # Let the producer finish, it stops after the chunk it is
+            # producing and closes the stream on its own thread
+            cancelled.set()
+            while not producer.done():
+                getter = asyncio.ensure_future(chunks.get())
+                await asyncio.wait([getter, producer],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                getter.cancel()
+
+    async def _call(self, writer, method, path, version, headers, body,
+                    keep_alive):
+        """
+        Answer one request, returns False when the connection must be closed
+        """
+        if method not in ('GET', 'POST'):
+            self._write(writer, 501, b'', keep_alive)
+            return True
+
+        code = check_auth(headers.get('authorization'))
+        if code:
+            self._write(writer, code, b'', keep_alive)
+            return True
+
+        if method == 'GET':
+            if path != "/metrics":
+                self._write(writer, 404, b'', keep_alive)
+            else:
+                self._write(writer, 200,
+                            metrics.registry.render().encode('utf-8'),
+                            keep_alive, metrics.CONTENT_TYPE)
+            return True
+
+        if path != "/targetrpc":
+            self._write(writer, 404, b'', keep_alive)
+            return True
+
+        return await self._stream(writer, rpc_stream(None, body), keep_alive,
+                                  version == 'HTTP/1.1')
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.TimeoutError, ValueError):
+                    break
+                if request is None:
+                    break
+
+                method, path, version, headers = request
+                keep_alive = self._keep_alive(version, headers)
+
+                if 'transfer-encoding' in headers:
+                    self._write(writer, 411, b'', False)
+                    break
+
+                body = b''
+                if 'content-length' in headers:
+                    try:
+                        length = int(headers['content-length'])
+                    except ValueError:
+                        self._write(writer, 400, b'', False)
+                        break
+                    body = await reader.readexactly(length)
+
+                sent = await self._call(writer, method, path, version,
+                                        headers, body, keep_alive)
+                if not await self._drain(writer):
+                    break
+
+                if not sent or not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        except asyncio.CancelledError:
+            # Shutting down, see serve()
+            pass
+        except Exception:
+            log.exception("Unexpected error on connection")
+        finally:
+            writer.close()
+
+
+def serve(config, address=('', 18700)):
+    """
+    Run the asyncio front end until interrupted
+    """
+    service = AsyncService(config)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    utils.set_event_loop(loop)
+
+    server = loop.run_until_complete(
+        asyncio.start_server(service.handle, address[0], address[1],
+                             ssl=ssl_context() if config['ssl'] else None))
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        # Worker threads waiting for the loop give up, later commands are
+        # run without it
+        utils.set_event_loop(None)
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(server.wait_closed())
+        # The loop runs meanwhile, the workers may still hand it callbacks
+        loop.run_until_complete(
+            loop.run_in_executor(None, service.executor.shutdown, True))
+        loop.close()
@@ -17,7 +17,7 @@
 
 from rtslib_fb import (Target, TPG, NodeACL, FabricModule, BlockStorageObject,
                        RTSRoot, NetworkPortal, LUN, MappedLUN, RTSLibError,
-                       RTSLibNotInCFS, NodeACLGroup)
+                       RTSLibNotInCFS)
 
 import gi
 gi.require_version("GLib", "2.0")
@@ -26,8 +26,16 @@ gi.require_version("BlockDev", "2.0")
 from gi.repository import GLib
 from gi.repository import BlockDev as bd
 
+import os
+import time
+import threading
+from contextlib import contextmanager
+import logging as log
+
+from targetd import metrics
 from targetd.main import TargetdError
-from targetd.utils import ignored, name_check
+from targetd.utils import (ignored, name_check, locked, resource_locks,
+                           select)
 
 REQUESTED_PLUGIN_NAMES = {"lvm"}
 
@@ -49,6 +57,20 @@ except GLib.GError as err:
     raise RuntimeError("Failed to initialize libbd and its plugins (%s)" %
                        REQUESTED_PLUGIN_NAMES)
 
+# Time spent in libblockdev and in rtslib lookups/creation of configfs objects
+# is reported on /metrics
+lvm = metrics.Instrumented('libblockdev', bd.lvm)
+
+Target = metrics.timed_call('rtslib', 'Target', Target)
+TPG = metrics.timed_call('rtslib', 'TPG', TPG)
+NodeACL = metrics.timed_call('rtslib', 'NodeACL', NodeACL)
+FabricModule = metrics.timed_call('rtslib', 'FabricModule', FabricModule)
+BlockStorageObject = metrics.timed_call('rtslib', 'BlockStorageObject',
+                                        BlockStorageObject)
+NetworkPortal = metrics.timed_call('rtslib', 'NetworkPortal', NetworkPortal)
+LUN = metrics.timed_call('rtslib', 'LUN', LUN)
+MappedLUN = metrics.timed_call('rtslib', 'MappedLUN', MappedLUN)
+
 
 def get_vg_lv(pool_name):
     """
@@ -73,6 +95,404 @@ def pool_check(pool_name):
         raise TargetdError(TargetdError.INVALID_POOL, "Invalid pool")
 
 
+def _pool_lock(pool_name):
+    """
+    Name of the resource lock for a block pool.  LVM serializes on the VG, so
+    thin pools of the same VG share one lock.
+    """
+    return "block:%s" % get_vg_lv(pool_name)[0]
+
+
+def _arg_pool_lock(arg):
+    """
+    Return a lock name resolver for the pool passed in keyword argument 'arg',
+    unknown pools get no lock and are rejected by the handler itself.
+    """
+
+    def _resolve(kwargs):
+        pool_name = kwargs.get(arg)
+        if pool_name is None:
+            return None
+        vg_name = get_vg_lv(pool_name)[0]
+        if vg_name not in [get_vg_lv(x)[0] for x in pools]:
+            return None
+        return _pool_lock(pool_name)
+
+    return _resolve
+
+
+def pool_locks(kwargs=None):
+    """
+    Lock names of every configured block pool.
+    """
+    return [_pool_lock(p) for p in pools]
+
+
+# Lock protecting the LIO configfs tree, rtslib is not safe against
+# concurrent modification of the objects it walks.
+LIO_LOCK = "lio"
+
+
+class ConfigSaver(object):
+    """
+    Write-behind persistence of the LIO configuration.
+
+    Saving walks and serializes the whole configfs tree, so mutations only
+    mark the configuration dirty and a timer saves it once, 'delay' seconds
+    after the first unsaved change.  A delay of 0 saves synchronously.
+
+    flush() and save() must be called holding the LIO lock (read is
+    enough), the timer takes it itself.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self._lock = threading.Lock()
+        # rtslib writes the same temporary file on every save
+        self._save_mutex = threading.Lock()
+        self._dirty = False
+        self._timer = None
+
+    def mark_dirty(self):
+        if self.delay <= 0:
+            self.save()
+            return
+
+        with self._lock:
+            self._dirty = True
+            self._arm()
+
+    def _arm(self):
+        # called holding _lock
+        if self._timer is None:
+            self._timer = threading.Timer(self.delay, self._expired)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expired(self):
+        try:
+            with resource_locks.hold(reads=[LIO_LOCK]):
+                self.flush()
+        except Exception as e:
+            log.error("Unable to save LIO configuration: %s" % e)
+
+    def flush(self):
+        """
+        Save now if there are unsaved changes.
+        """
+        with self._lock:
+            dirty = self._dirty
+        if dirty:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            self._dirty = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        try:
+            with self._save_mutex, metrics.timed('rtslib', 'save_to_file'):
+                RTSRoot().save_to_file()
+        except Exception:
+            # Still unsaved: the timer tries again, flush() at shutdown too
+            with self._lock:
+                self._dirty = True
+                if self.delay > 0:
+                    self._arm()
+            raise
+
+
+config_saver = ConfigSaver()
+
+_save_state = threading.local()
+
+
+def _save_config():
+    """
+    Persist the LIO configuration after a change.  Inside saves_deferred()
+    this only notes that a save is needed, which is then done once when the
+    block exits.
+    """
+    if getattr(_save_state, 'depth', 0):
+        _save_state.dirty = True
+    else:
+        config_saver.mark_dirty()
+
+
+@contextmanager
+def saves_deferred():
+    """
+    Coalesce the LIO configuration saves of the calls made by this thread
+    within the block into a single save at its end.
+    """
+    depth = getattr(_save_state, 'depth', 0)
+    _save_state.depth = depth + 1
+    try:
+        yield
+    finally:
+        _save_state.depth = depth
+        if depth == 0 and getattr(_save_state, 'dirty', False):
+            _save_state.dirty = False
+            try:
+                with resource_locks.hold(reads=[LIO_LOCK]):
+                    config_saver.save()
+            except Exception as e:
+                log.error("Unable to save LIO configuration: %s" % e)
+
+
+def flush_config():
+    """
+    Save any pending LIO configuration change, used at shutdown.
+    """
+    with resource_locks.hold(reads=[LIO_LOCK]):
+        config_saver.flush()
+
+
+def config_flush(req):
+    """
+    Save pending LIO configuration changes now instead of waiting for the
+    write-behind timer.
+    """
+    config_saver.flush()
+
+
+class _Topology(object):
+    """
+    LUNs and node ACLs of the iSCSI TPG, see LioIndex.
+    """
+
+    def __init__(self):
+        # block storage object name -> TPG LUN index
+        self.luns = {}
+        # TPG LUN index -> storage object name
+        self.so_names = {}
+        # initiator wwn -> dict(tag=access group name or None,
+        #                       mapped={mapped LUN: TPG LUN index})
+        self.acls = {}
+
+    def add_lun(self, so_name, lun_index, block=True):
+        if block:
+            self.luns[so_name] = lun_index
+        self.so_names[lun_index] = so_name
+
+    def remove_lun(self, lun_index):
+        so_name = self.so_names.pop(lun_index, None)
+        if self.luns.get(so_name) == lun_index:
+            del self.luns[so_name]
+
+    def add_acl(self, wwn, tag=None):
+        if wwn not in self.acls:
+            self.acls[wwn] = dict(tag=tag, mapped={})
+
+    def set_acl(self, node_acl):
+        """
+        (Re)read a single node ACL from configfs.
+        """
+        self.acls[node_acl.node_wwn] = dict(
+            tag=node_acl.tag,
+            mapped=dict((m.mapped_lun, m.tpg_lun.lun)
+                        for m in node_acl.mapped_luns))
+
+    def remove_acl(self, wwn):
+        self.acls.pop(wwn, None)
+
+    def group_members(self, ag_name):
+        return [w for w, a in self.acls.items() if a['tag'] == ag_name]
+
+    def groups(self):
+        """
+        Returns {access group name: [initiator wwn, ...]}
+        """
+        rc = {}
+        for wwn, acl in self.acls.items():
+            if acl['tag'] is not None:
+                rc.setdefault(acl['tag'], []).append(wwn)
+        return rc
+
+    def is_mapped(self, lun_index):
+        return any(lun_index in acl['mapped'].values()
+                   for acl in self.acls.values())
+
+    def signature(self):
+        return frozenset(self.so_names), frozenset(self.acls)
+
+
+class LioIndex(object):
+    """
+    In memory index of the iSCSI TPG targetd manages: LUNs by storage object
+    name and node ACLs (access group tag, mapped LUNs) by initiator wwn, so
+    lookups don't walk configfs.
+
+    The index is built by one configfs walk and then kept up to date by
+    targetd's own changes.  Changes made by someone else (targetcli, ...)
+    are detected by comparing the LUN and ACL directory names of the TPG on
+    every use, and anything else by a full rescan every 'rescan_interval'
+    seconds.
+
+    Callers hold the LIO lock: shared to read the topology, exclusive to
+    change the TPG and the topology along with it.
+    """
+
+    def __init__(self, rescan_interval=60):
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._topology = None
+        self._scanned = 0
+
+    @staticmethod
+    def _listing(tpg):
+        try:
+            luns = frozenset(
+                int(n[len('lun_'):])
+                for n in os.listdir(os.path.join(tpg.path, 'lun'))
+                if n.startswith('lun_'))
+            acls = frozenset(os.listdir(os.path.join(tpg.path, 'acls')))
+        except OSError:
+            return frozenset(), frozenset()
+        return luns, acls
+
+    @staticmethod
+    def _scan(tpg):
+        topology = _Topology()
+        with ignored(RTSLibNotInCFS), metrics.timed('rtslib', 'scan'):
+            for lun in tpg.luns:
+                so = lun.storage_object
+                topology.add_lun(so.name, lun.lun, so.plugin == 'block')
+            for node_acl in tpg.node_acls:
+                topology.set_acl(node_acl)
+        return topology
+
+    def topology(self, tpg):
+        """
+        Return the topology of tpg, rescanned first if it went stale.
+        """
+        with self._lock:
+            topology = self._topology
+            if topology is None or \
+                    time.time() - self._scanned > self.rescan_interval or \
+                    topology.signature() != self._listing(tpg):
+                if topology is not None:
+                    log.debug("Rescanning LIO configuration")
+                topology = self._scan(tpg)
+                self._topology = topology
+                self._scanned = time.time()
+            return topology
+
+    def invalidate(self):
+        with self._lock:
+            self._topology = None
+
+
+lio_index = LioIndex()
+
+
+class LvmCache(object):
+    """
+    Per VG cache of the LVM metadata targetd reads (lvs, vginfo), so that
+    polling vol_list, pool_list or export_list doesn't cost an LVM metadata
+    scan each time.
+
+    Entries expire after 'ttl' seconds (0 disables the cache) and are
+    dropped by targetd's own changes to the VG.  Callers hold the pool lock
+    of the VG: shared to read, exclusive to change the VG and invalidate.
+    """
+
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # vg name -> dict(time=..., lvs={lv name: lv}, vg=vginfo or None)
+        self._vgs = {}
+
+    def _fresh(self, vg_name):
+        entry = self._vgs.get(vg_name)
+        if entry is not None and time.time() - entry['time'] < self.ttl:
+            return entry
+        return None
+
+    def _entry(self, vg_name):
+        with self._lock:
+            entry = self._fresh(vg_name)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        lvs = lvm.lvs(vg_name)
+        entry = dict(time=time.time(), vg=None,
+                     lvs=dict((lv.lv_name, lv) for lv in lvs),
+                     uuids=dict((lv.uuid, lv) for lv in lvs))
+        if self.ttl > 0:
+            with self._lock:
+                self._vgs[vg_name] = entry
+        return entry
+
+    def lvs(self, vg_name):
+        return list(self._entry(vg_name)['lvs'].values())
+
+    def lvinfo(self, vg_name, lv_name):
+        lv = self._entry(vg_name)['lvs'].get(lv_name)
+        if lv is None:
+            # Let LVM report the error for a volume that doesn't exist
+            lv = lvm.lvinfo(vg_name, lv_name)
+        return lv
+
+    def lookup(self, vg_name, lv_name):
+        """
+        Like lvinfo(), but a VG that isn't cached isn't scanned as a whole
+        just to look up one volume.
+        """
+        with self._lock:
+            entry = self._fresh(vg_name)
+            if entry is not None and lv_name in entry['lvs']:
+                self.hits += 1
+                return entry['lvs'][lv_name]
+            self.misses += 1
+        return lvm.lvinfo(vg_name, lv_name)
+
+    def lookup_uuid(self, vg_name, lv_uuid):
+        """
+        Returns the LV with uuid lv_uuid or None, LVM can't look a volume up
+        by uuid so this needs (and caches) the VG scan.
+        """
+        return self._entry(vg_name)['uuids'].get(lv_uuid)
+
+    def vginfo(self, vg_name):
+        entry = self._entry(vg_name)
+        if entry['vg'] is None:
+            entry['vg'] = lvm.vginfo(vg_name)
+        return entry['vg']
+
+    def has_lv(self, vg_name, lv_name):
+        return lv_name in self._entry(vg_name)['lvs']
+
+    def invalidate(self, vg_name=None):
+        with self._lock:
+            if vg_name is None:
+                self._vgs.clear()
+            else:
+                self._vgs.pop(vg_name, None)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
+
+
+lvm_cache = LvmCache()
+
+
+def _cache_metrics():
+    return [('targetd_lvm_cache_lookups_total',
+             'LVM metadata cache lookups by result', 'counter',
+             {(('result', 'hit'),): lvm_cache.hits,
+              (('result', 'miss'),): lvm_cache.misses})]
+
+
+metrics.registry.add_collector(_cache_metrics)
+
+
 def set_portal_addresses(tpg):
     for a in addresses:
         NetworkPortal(tpg, a)
@@ -97,6 +517,10 @@ def initialize(config_dict):
     global addresses
     addresses = config_dict['portal_addresses']
 
+    config_saver.delay = config_dict['lio_save_delay']
+    lio_index.rescan_interval = config_dict['lio_index_rescan']
+    lvm_cache.ttl = config_dict['lvm_cache_ttl']
+
     # fail early if can't access any vg
     for pool in pools:
         thinp = None
@@ -106,7 +530,7 @@ def initialize(config_dict):
         if vg_name and thin_pool:
             # We have VG name and LV name, check for it!
             try:
-                thinp = bd.lvm.lvinfo(vg_name, thin_pool)
+                thinp = lvm.lvinfo(vg_name, thin_pool)
             except bd.LVMError as lve:
                 error = str(lve).strip()
 
@@ -116,7 +540,7 @@ def initialize(config_dict):
                                    "nested error: {}".format(pool, error))
         else:
             try:
-                bd.lvm.vginfo(vg_name)
+                lvm.vginfo(vg_name)
             except bd.LVMError as vge:
                 error = str(vge).strip()
                 raise TargetdError(TargetdError.NOT_FOUND_VOLUME_GROUP,
@@ -133,61 +557,115 @@ def initialize(config_dict):
                 TargetdError.INVALID,
                 "VG pool and thin pool from same VG not supported")
 
+    # build the LIO index now instead of on the first request
+    with ignored(RTSLibNotInCFS, RTSLibError):
+        lio_index.topology(
+            TPG(Target(FabricModule('iscsi'), target_name, mode='lookup'),
+                1, mode='lookup'))
+
+    pool_arg = _arg_pool_lock('pool')
+    pool_name_arg = _arg_pool_lock('pool_name')
+
     return dict(
-        vol_list=volumes,
-        vol_create=create,
-        vol_destroy=destroy,
-        vol_copy=copy,
-        export_list=export_list,
-        export_create=export_create,
-        export_destroy=export_destroy,
-        initiator_set_auth=initiator_set_auth,
-        initiator_list=initiator_list,
-        access_group_list=access_group_list,
-        access_group_create=access_group_create,
-        access_group_destroy=access_group_destroy,
-        access_group_init_add=access_group_init_add,
-        access_group_init_del=access_group_init_del,
-        access_group_map_list=access_group_map_list,
-        access_group_map_create=access_group_map_create,
-        access_group_map_destroy=access_group_map_destroy,
+        vol_list=locked(volumes, reads=[pool_arg]),
+        vol_get=locked(vol_get, reads=[pool_arg]),
+        vol_create=locked(create, writes=[pool_arg]),
+        vol_destroy=locked(destroy, reads=[LIO_LOCK], writes=[pool_arg]),
+        vol_copy=locked(copy, writes=[pool_arg]),
+        export_list=locked(export_list, reads=[LIO_LOCK, pool_locks]),
+        export_get=locked(export_get, reads=[LIO_LOCK, pool_arg]),
+        export_create=locked(
+            export_create, reads=[pool_arg], writes=[LIO_LOCK]),
+        export_destroy=locked(export_destroy, writes=[LIO_LOCK]),
+        initiator_set_auth=locked(initiator_set_auth, writes=[LIO_LOCK]),
+        initiator_list=locked(initiator_list, reads=[LIO_LOCK]),
+        access_group_list=locked(access_group_list, reads=[LIO_LOCK]),
+        access_group_create=locked(access_group_create, writes=[LIO_LOCK]),
+        access_group_destroy=locked(access_group_destroy, writes=[LIO_LOCK]),
+        access_group_init_add=locked(
+            access_group_init_add, writes=[LIO_LOCK]),
+        access_group_init_del=locked(
+            access_group_init_del, writes=[LIO_LOCK]),
+        access_group_map_list=locked(
+            access_group_map_list, reads=[LIO_LOCK]),
+        access_group_map_create=locked(
+            access_group_map_create, reads=[pool_name_arg],
+            writes=[LIO_LOCK]),
+        access_group_map_destroy=locked(
+            access_group_map_destroy, reads=[pool_name_arg],
+            writes=[LIO_LOCK]),
+        config_flush=locked(config_flush, reads=[LIO_LOCK]),
     )
 
 
-def volumes(req, pool):
+def _pool_volume(lv, lv_pool):
+    """
+    True if lv is a volume of the pool, lv_pool being the thin pool of the
+    pool or None
+    """
+    if not lv_pool:
+        return lv.attr[0] == '-'
+    return lv.attr[0] == 'V' and lv.pool_lv == lv_pool
+
+
+def volumes(req, pool, offset=None, limit=None, after=None, name=None,
+            name_prefix=None, uuid=None):
     output = []
     vg_name, lv_pool = get_vg_lv(pool)
-    for lv in bd.lvm.lvs(vg_name):
-        attrib = lv.attr
-        if not lv_pool:
-            if attrib[0] == '-':
-                output.append(
-                    dict(name=lv.lv_name, size=lv.size, uuid=lv.uuid))
-        else:
-            if attrib[0] == 'V' and lv.pool_lv == lv_pool:
-                output.append(
-                    dict(name=lv.lv_name, size=lv.size, uuid=lv.uuid))
+    for lv in lvm_cache.lvs(vg_name):
+        if _pool_volume(lv, lv_pool):
+            output.append(dict(name=lv.lv_name, size=lv.size, uuid=lv.uuid))
+
+    return select(output, ('name',), offset, limit, after,
+                  prefixes=dict(name=name_prefix), name=name, uuid=uuid)
 
-    return output
+
+def vol_get(req, pool, name=None, uuid=None):
+    """
+    Return the volume of pool with the given name or uuid, like an entry of
+    vol_list, without listing the pool.
+    """
+    if (name is None) == (uuid is None):
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "Exactly one of name and uuid is required")
+
+    vg_name, lv_pool = get_vg_lv(pool)
+
+    lv = None
+    if name is not None:
+        with ignored(bd.LVMError):
+            lv = lvm_cache.lookup(vg_name, name)
+    else:
+        lv = lvm_cache.lookup_uuid(vg_name, uuid)
+
+    if lv is None or not _pool_volume(lv, lv_pool):
+        raise TargetdError(TargetdError.NOT_FOUND_VOLUME,
+                           "Volume not found in pool %s" % pool)
+
+    return dict(name=lv.lv_name, size=lv.size, uuid=lv.uuid)
 
 
 def create(req, pool, name, size):
 
+    vg_name, lv_pool = get_vg_lv(pool)
+
     # Check to ensure that we don't have a volume with this name already,
     # lvm will fail if we try to create a LV with a duplicate name
-    if any(v['name'] == name for v in volumes(req, pool)):
+    if lvm_cache.has_lv(vg_name, name):
         raise TargetdError(TargetdError.NAME_CONFLICT,
                            "Volume with that name exists")
 
-    vg_name, lv_pool = get_vg_lv(pool)
-    if lv_pool:
-        # Fall back to non-thinp if needed
-        try:
-            bd.lvm.thlvcreate(vg_name, lv_pool, name, int(size))
-        except bd.LVMError:
-            bd.lvm.lvcreate(vg_name, name, int(size), 'linear')
-    else:
-        bd.lvm.lvcreate(vg_name, name, int(size), 'linear')
+    try:
+        if lv_pool:
+            # Fall back to non-thinp if needed
+            try:
+                lvm.thlvcreate(vg_name, lv_pool, name, int(size))
+            except bd.LVMError:
+                lvm.lvcreate(vg_name, name, int(size), 'linear')
+        else:
+            lvm.lvcreate(vg_name, name, int(size), 'linear')
+    finally:
+        lvm_cache.invalidate(vg_name)
 
 
 def destroy(req, pool, name):
@@ -199,13 +677,16 @@ def destroy(req, pool, name):
         vg_name, lv_pool = get_vg_lv(pool)
         so_name = "%s:%s" % (vg_name, name)
 
-        if so_name in (lun.storage_object.name for lun in tpg.luns):
+        if so_name in lio_index.topology(tpg).luns:
             raise TargetdError(TargetdError.VOLUME_MASKED,
                                "Volume '%s' cannot be "
                                "removed while exported" % name)
 
     vg_name, lv_pool = get_vg_lv(pool)
-    bd.lvm.lvremove(vg_name, name)
+    try:
+        lvm.lvremove(vg_name, name)
+    finally:
+        lvm_cache.invalidate(vg_name)
 
 
 def copy(req, pool, vol_orig, vol_new, timeout=10):
@@ -213,24 +694,27 @@ def copy(req, pool, vol_orig, vol_new, timeout=10):
     Create a new volume that is a copy of an existing one.
     Since 0.6, requires thinp support.
     """
-    if any(v['name'] == vol_new for v in volumes(req, pool)):
+    vg_name, thin_pool = get_vg_lv(pool)
+
+    if lvm_cache.has_lv(vg_name, vol_new):
         raise TargetdError(TargetdError.NAME_CONFLICT,
                            "Volume with that name exists")
 
-    vg_name, thin_pool = get_vg_lv(pool)
-
     if not thin_pool:
         raise RuntimeError("copy requires thin-provisioned volumes")
 
     try:
-        bd.lvm.thsnapshotcreate(vg_name, vol_orig, vol_new, thin_pool)
+        lvm.thsnapshotcreate(vg_name, vol_orig, vol_new, thin_pool)
     except bd.LVMError as err:
         raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
                            "Failed to copy volume, "
                            "nested error: {}".format(str(err).strip()))
+    finally:
+        lvm_cache.invalidate(vg_name)
 
 
-def export_list(req):
+def export_list(req, pool=None, initiator_wwn=None, offset=None, limit=None,
+                after=None, name=None, name_prefix=None, uuid=None):
     try:
         fm = FabricModule('iscsi')
         t = Target(fm, target_name, mode='lookup')
@@ -238,22 +722,79 @@ def export_list(req):
     except RTSLibNotInCFS:
         return []
 
-    exports = []
-    for na in tpg.node_acls:
-        for mlun in na.mapped_luns:
-            mlun_vg, mlun_name = \
-                mlun.tpg_lun.storage_object.udev_path.split("/")[2:]
-
-            lv = bd.lvm.lvinfo(mlun_vg, mlun_name)
-            exports.append(
-                dict(
-                    initiator_wwn=na.node_wwn,
-                    lun=mlun.mapped_lun,
+    topology = lio_index.topology(tpg)
+
+    pool_vg = None
+    if pool is not None:
+        pool_vg = get_vg_lv(pool)[0]
+    if initiator_wwn is not None:
+        initiator_wwn = initiator_wwn.lower()
+
+    def _exports():
+        # built as they are sent, see rpc_stream()
+        for wwn, acl in topology.acls.items():
+            if initiator_wwn is not None and wwn.lower() != initiator_wwn:
+                continue
+            for mapped_lun, lun_index in acl['mapped'].items():
+                # so.name concats pool & vol names separated by ':'
+                mlun_vg, mlun_name = topology.so_names[lun_index].split(":")
+
+                # skip the LVM lookup of exports filtered out anyway
+                if pool_vg is not None and mlun_vg != pool_vg or \
+                        name is not None and mlun_name != name or \
+                        name_prefix is not None and \
+                        not mlun_name.startswith(name_prefix):
+                    continue
+
+                lv = lvm_cache.lvinfo(mlun_vg, mlun_name)
+                yield dict(
+                    initiator_wwn=wwn,
+                    lun=mapped_lun,
                     vol_name=mlun_name,
                     pool=mlun_vg,
                     vol_uuid=lv.uuid,
-                    vol_size=lv.size))
-    return exports
+                    vol_size=lv.size)
+
+    return select(_exports(), ('initiator_wwn', 'lun'), offset, limit, after,
+                  vol_uuid=uuid)
+
+
+def export_get(req, pool, vol, initiator_wwn):
+    """
+    Return the export of volume vol of pool to initiator_wwn, like an entry
+    of export_list, from the LIO index.
+    """
+    vg_name, lv_pool = get_vg_lv(pool)
+    so_name = "%s:%s" % (vg_name, vol)
+
+    with ignored(RTSLibNotInCFS):
+        fm = FabricModule('iscsi')
+        t = Target(fm, target_name, mode='lookup')
+        tpg = TPG(t, 1, mode='lookup')
+
+        topology = lio_index.topology(tpg)
+        lun_index = topology.luns.get(so_name)
+        wwn = initiator_wwn
+        if wwn not in topology.acls:
+            # rtslib stores iqn names in lower case
+            wwn = wwn.lower()
+        acl = topology.acls.get(wwn)
+
+        if lun_index is not None and acl is not None:
+            for mapped_lun, index in acl['mapped'].items():
+                if index == lun_index:
+                    lv = lvm_cache.lookup(vg_name, vol)
+                    return dict(
+                        initiator_wwn=wwn,
+                        lun=mapped_lun,
+                        vol_name=vol,
+                        pool=vg_name,
+                        vol_uuid=lv.uuid,
+                        vol_size=lv.size)
+
+    raise TargetdError(TargetdError.NOT_FOUND_VOLUME_EXPORT,
+                       "Volume '%s' not found in %s exports" %
+                       (vol, initiator_wwn))
 
 
 def export_create(req, pool, vol, initiator_wwn, lun):
@@ -265,18 +806,20 @@ def export_create(req, pool, vol, initiator_wwn, lun):
 
     set_portal_addresses(tpg)
 
+    topology = lio_index.topology(tpg)
+
     na = NodeACL(tpg, initiator_wwn)
+    topology.add_acl(na.node_wwn)
 
-    tpg_lun = _tpg_lun_of(tpg, pool, vol)
+    tpg_lun = _tpg_lun_of(tpg, topology, pool, vol)
 
     # only add mapped lun if it doesn't exist
-    for tmp_mlun in tpg_lun.mapped_luns:
-        if tmp_mlun.mapped_lun == lun and tmp_mlun.parent_nodeacl == na:
-            break
-    else:
+    mapped = topology.acls[na.node_wwn]['mapped']
+    if mapped.get(lun) != tpg_lun.lun:
         MappedLUN(na, lun, tpg_lun)
+        mapped[lun] = tpg_lun.lun
 
-    RTSRoot().save_to_file()
+    _save_config()
 
 
 def export_destroy(req, pool, vol, initiator_wwn):
@@ -284,23 +827,25 @@ def export_destroy(req, pool, vol, initiator_wwn):
     fm = FabricModule('iscsi')
     t = Target(fm, target_name)
     tpg = TPG(t, 1)
+    topology = lio_index.topology(tpg)
     na = NodeACL(tpg, initiator_wwn)
+    topology.add_acl(na.node_wwn)
 
     vg_name, thin_pool = get_vg_lv(pool)
+    so_name = "%s:%s" % (vg_name, vol)
 
-    for mlun in na.mapped_luns:
-        # all SOs are Block so we can access udev_path safely
-        mlun_vg, mlun_name = \
-            mlun.tpg_lun.storage_object.udev_path.split("/")[2:]
-
-        if mlun_vg == vg_name and mlun_name == vol:
-            tpg_lun = mlun.tpg_lun
-            mlun.delete()
+    mapped = topology.acls[na.node_wwn]['mapped']
+    for mapped_lun, lun_index in mapped.items():
+        if topology.so_names.get(lun_index) == so_name:
+            MappedLUN(na, mapped_lun).delete()
+            del mapped[mapped_lun]
             # be tidy and delete unused tpg lun mappings?
-            if not any(tpg_lun.mapped_luns):
+            if not topology.is_mapped(lun_index):
+                tpg_lun = LUN(tpg, lun_index)
                 so = tpg_lun.storage_object
                 tpg_lun.delete()
                 so.delete()
+                topology.remove_lun(lun_index)
             break
     else:
         raise TargetdError(TargetdError.NOT_FOUND_VOLUME_EXPORT,
@@ -308,14 +853,16 @@ def export_destroy(req, pool, vol, initiator_wwn):
                            (vol, initiator_wwn))
 
     # Clean up tree if branch has no leaf
-    if not any(na.mapped_luns):
+    if not mapped:
+        topology.remove_acl(na.node_wwn)
         na.delete()
-        if not any(tpg.node_acls):
+        if not topology.acls:
             tpg.delete()
+            lio_index.invalidate()
             if not any(t.tpgs):
                 t.delete()
 
-    RTSRoot().save_to_file()
+    _save_config()
 
 
 def initiator_set_auth(req, initiator_wwn, in_user, in_pass, out_user,
@@ -323,7 +870,9 @@ def initiator_set_auth(req, initiator_wwn, in_user, in_pass, out_user,
     fm = FabricModule('iscsi')
     t = Target(fm, target_name)
     tpg = TPG(t, 1)
+    topology = lio_index.topology(tpg)
     na = NodeACL(tpg, initiator_wwn)
+    topology.add_acl(na.node_wwn)
 
     if not in_user or not in_pass:
         # rtslib treats '' as its NULL value for these
@@ -338,7 +887,7 @@ def initiator_set_auth(req, initiator_wwn, in_user, in_pass, out_user,
     na.chap_mutual_userid = out_user
     na.chap_mutual_password = out_pass
 
-    RTSRoot().save_to_file()
+    _save_config()
 
 
 def block_pools(req):
@@ -370,7 +919,7 @@ def block_pools(req):
     for pool in pools:
         vg_name, tp_name = get_vg_lv(pool)
         if not tp_name:
-            vg = bd.lvm.vginfo(vg_name)
+            vg = lvm_cache.vginfo(vg_name)
             results.append(
                 dict(
                     name=pool,
@@ -379,7 +928,7 @@ def block_pools(req):
                     type='block',
                     uuid=vg.uuid))
         else:
-            thinp = bd.lvm.lvinfo(vg_name, tp_name)
+            thinp = lvm_cache.lvinfo(vg_name, tp_name)
             results.append(
                 dict(
                     name=pool,
@@ -400,7 +949,7 @@ def _get_iscsi_tpg():
 def initiator_list(req, standalone_only=False):
     """Return a list of initiator
 
-    Iterate all iSCSI rtslib-fb.NodeACL via rtslib-fb.TPG.node_acls().
+    Served from the in-memory index of the iSCSI TPG (see LioIndex).
     Args:
         req (TargetHandler):  Reserved for future use.
         standalone_only (bool):
@@ -420,23 +969,23 @@ def initiator_list(req, standalone_only=False):
         N/A
     """
 
-    def _condition(node_acl, _standalone_only):
-        if _standalone_only and node_acl.tag is not None:
+    def _condition(acl, _standalone_only):
+        if _standalone_only and acl['tag'] is not None:
             return False
         else:
             return True
 
     return list({
-        'init_id': node_acl.node_wwn,
+        'init_id': wwn,
         'init_type': 'iscsi'
-    } for node_acl in _get_iscsi_tpg().node_acls
-                if _condition(node_acl, standalone_only))
+    } for wwn, acl in lio_index.topology(_get_iscsi_tpg()).acls.items()
+                if _condition(acl, standalone_only))
 
 
 def access_group_list(req):
     """Return a list of access group
 
-    Iterate all iSCSI rtslib-fb.NodeACLGroup via rtslib-fb.TPG.node_acls().
+    Served from the in-memory index of the iSCSI TPG (see LioIndex).
     Args:
         req (TargetHandler):  Reserved for future use.
     Returns:
@@ -453,10 +1002,11 @@ def access_group_list(req):
         N/A
     """
     return list({
-        'name': node_acl_group.name,
-        'init_ids': list(node_acl_group.wwns),
+        'name': ag_name,
+        'init_ids': wwns,
         'init_type': 'iscsi',
-    } for node_acl_group in _get_iscsi_tpg().node_acl_groups)
+    } for ag_name, wwns in lio_index.topology(
+        _get_iscsi_tpg()).groups().items())
 
 
 def access_group_create(req, ag_name, init_id, init_type):
@@ -466,28 +1016,36 @@ def access_group_create(req, ag_name, init_id, init_type):
     name_check(ag_name)
 
     tpg = _get_iscsi_tpg()
+    topology = lio_index.topology(tpg)
 
     # Pre-check:
     #   1. Name conflict: requested name is in use
     #   2. Initiator conflict:  request initiator is in use
 
-    for node_acl_group in tpg.node_acl_groups:
-        if node_acl_group.name == ag_name:
-            raise TargetdError(TargetdError.NAME_CONFLICT,
-                               "Requested access group name is in use")
+    if topology.group_members(ag_name):
+        raise TargetdError(TargetdError.NAME_CONFLICT,
+                           "Requested access group name is in use")
 
-    if init_id in list(i.node_wwn for i in tpg.node_acls):
+    if init_id in topology.acls:
         raise TargetdError(TargetdError.EXISTS_INITIATOR,
                            "Requested init_id is in use")
 
-    node_acl_group = NodeACLGroup(tpg, ag_name)
-    node_acl_group.add_acl(init_id)
-    RTSRoot().save_to_file()
+    # An access group is the set of node ACLs tagged with its name
+    node_acl = NodeACL(tpg, init_id)
+    node_acl.tag = ag_name
+    topology.add_acl(node_acl.node_wwn, ag_name)
+    _save_config()
 
 
 def access_group_destroy(req, ag_name):
-    NodeACLGroup(_get_iscsi_tpg(), ag_name).delete()
-    RTSRoot().save_to_file()
+    tpg = _get_iscsi_tpg()
+    topology = lio_index.topology(tpg)
+
+    # Deleting the member ACLs is what deletes the group
+    for wwn in topology.group_members(ag_name):
+        NodeACL(tpg, wwn, mode='lookup').delete()
+        topology.remove_acl(wwn)
+    _save_config()
 
 
 def access_group_init_add(req, ag_name, init_id, init_type):
@@ -495,26 +1053,40 @@ def access_group_init_add(req, ag_name, init_id, init_type):
         raise TargetdError(TargetdError.NO_SUPPORT, "Only support iscsi")
 
     tpg = _get_iscsi_tpg()
+    topology = lio_index.topology(tpg)
     # Pre-check:
     #   1. Already in requested access group, return silently.
     #   2. Initiator does not exist.
     #   3. Initiator not used by other access group.
 
-    if init_id in list(NodeACLGroup(tpg, ag_name).wwns):
-        return
-
-    for node_acl_group in tpg.node_acl_groups:
-        if init_id in list(node_acl_group.wwns):
+    acl = topology.acls.get(init_id)
+    if acl is not None:
+        if acl['tag'] == ag_name:
+            return
+        if acl['tag'] is not None:
             raise TargetdError(
                 TargetdError.EXISTS_INITIATOR,
                 "Requested init_id is used by other access group")
-    for node_acl in tpg.node_acls:
-        if init_id == node_acl.node_wwn:
-            raise TargetdError(TargetdError.EXISTS_INITIATOR,
-                               "Requested init_id is in use")
+        raise TargetdError(TargetdError.EXISTS_INITIATOR,
+                           "Requested init_id is in use")
 
-    NodeACLGroup(tpg, ag_name).add_acl(init_id)
-    RTSRoot().save_to_file()
+    # The new member takes the LUN mappings of the group
+    members = topology.group_members(ag_name)
+    group_mapped = {}
+    if members:
+        group_mapped = topology.acls[members[0]]['mapped']
+        member_acl = NodeACL(tpg, members[0], mode='lookup')
+
+    node_acl = NodeACL(tpg, init_id)
+    node_acl.tag = ag_name
+    topology.add_acl(node_acl.node_wwn, ag_name)
+    for mapped_lun, lun_index in group_mapped.items():
+        # read-only mappings stay read-only for the new member
+        write_protect = MappedLUN(member_acl, mapped_lun).write_protect
+        MappedLUN(node_acl, mapped_lun, LUN(tpg, lun_index),
+                  write_protect=write_protect)
+        topology.acls[node_acl.node_wwn]['mapped'][mapped_lun] = lun_index
+    _save_config()
 
 
 def access_group_init_del(req, ag_name, init_id, init_type):
@@ -522,14 +1094,16 @@ def access_group_init_del(req, ag_name, init_id, init_type):
         raise TargetdError(TargetdError.NO_SUPPORT, "Only support iscsi")
 
     tpg = _get_iscsi_tpg()
+    topology = lio_index.topology(tpg)
 
     # Pre-check:
     #   1. Initiator is not in requested access group, return silently.
-    if init_id not in list(NodeACLGroup(tpg, ag_name).wwns):
+    if init_id not in topology.group_members(ag_name):
         return
 
-    NodeACLGroup(tpg, ag_name).remove_acl(init_id)
-    RTSRoot().save_to_file()
+    NodeACL(tpg, init_id, mode='lookup').delete()
+    topology.remove_acl(init_id)
+    _save_config()
 
 
 def access_group_map_list(req):
@@ -543,23 +1117,28 @@ def access_group_map_list(req):
         }
     """
     results = []
-    tpg = _get_iscsi_tpg()
+    topology = lio_index.topology(_get_iscsi_tpg())
     vg_name_2_pool_name_dict = {}
     for pool_name in pools:
         vg_name = get_vg_lv(pool_name)[0]
         vg_name_2_pool_name_dict[vg_name] = pool_name
 
-    for node_acl_group in tpg.node_acl_groups:
-        for mapped_lun_group in node_acl_group.mapped_lun_groups:
-            tpg_lun = mapped_lun_group.tpg_lun
-            so_name = tpg_lun.storage_object.name
+    for ag_name, wwns in topology.groups().items():
+        # every member of a group carries the group's mapped LUNs
+        mapped_lun_groups = {}
+        for wwn in wwns:
+            for mapped_lun, lun_index in topology.acls[wwn]['mapped'].items():
+                mapped_lun_groups.setdefault(mapped_lun, lun_index)
+
+        for mapped_lun, lun_index in mapped_lun_groups.items():
+            so_name = topology.so_names[lun_index]
             (vg_name, vol_name) = so_name.split(":")
             # When user delete old volume and the created new one with
             # idential name. The mapping status will be kept.
             # Hence we don't expose volume UUID here.
             results.append({
-                'ag_name': node_acl_group.name,
-                'h_lun_id': mapped_lun_group.mapped_lun,
+                'ag_name': ag_name,
+                'h_lun_id': mapped_lun,
                 'pool_name': vg_name_2_pool_name_dict[vg_name],
                 'vol_name': vol_name,
             })
@@ -567,18 +1146,24 @@ def access_group_map_list(req):
     return results
 
 
-def _tpg_lun_of(tpg, pool_name, vol_name):
+def _tpg_lun_of(tpg, topology, pool_name, vol_name):
     """
     Return a object of LUN for given lvm lv.
     If not exist, create one.
     """
-    # get wwn of volume so LIO can export as vpd83 info
     vg_name, thin_pool = get_vg_lv(pool_name)
-    vol_serial = bd.lvm.lvinfo(vg_name, vol_name).uuid
 
-    # only add new SO if it doesn't exist
     # so.name concats pool & vol names separated by ':'
     so_name = "%s:%s" % (vg_name, vol_name)
+
+    # only add tpg lun if it doesn't exist
+    if so_name in topology.luns:
+        return LUN(tpg, topology.luns[so_name])
+
+    # get wwn of volume so LIO can export as vpd83 info
+    vol_serial = lvm_cache.lvinfo(vg_name, vol_name).uuid
+
+    # only add new SO if it doesn't exist
     try:
         so = BlockStorageObject(so_name)
     except RTSLibError:
@@ -590,13 +1175,9 @@ def _tpg_lun_of(tpg, pool_name, vol_name):
     with ignored(RTSLibError):
         so.set_attribute("emulate_model_alias", '1')
 
-    # only add tpg lun if it doesn't exist
-    for tmp_lun in tpg.luns:
-        if tmp_lun.storage_object.name == so.name and \
-           tmp_lun.storage_object.plugin == 'block':
-            return tmp_lun
-    else:
-        return LUN(tpg, storage_object=so)
+    tpg_lun = LUN(tpg, storage_object=so)
+    topology.add_lun(so_name, tpg_lun.lun)
+    return tpg_lun
 
 
 def access_group_map_create(req, pool_name, vol_name, ag_name, h_lun_id=None):
@@ -606,21 +1187,18 @@ def access_group_map_create(req, pool_name, vol_name, ag_name, h_lun_id=None):
 
     set_portal_addresses(tpg)
 
-    tpg_lun = _tpg_lun_of(tpg, pool_name, vol_name)
+    topology = lio_index.topology(tpg)
+    tpg_lun = _tpg_lun_of(tpg, topology, pool_name, vol_name)
+    members = topology.group_members(ag_name)
 
     # Pre-Check:
     #   1. Already mapped to requested access group, return None
-    if any(tpg_lun.mapped_luns):
-        tgt_map_list = access_group_map_list(req)
-        for tgt_map in tgt_map_list:
-            if tgt_map['ag_name'] == ag_name and \
-               tgt_map['pool_name'] == pool_name and \
-               tgt_map['vol_name'] == vol_name:
-                # Already masked.
-                return None
-
-    node_acl_group = NodeACLGroup(tpg, ag_name)
-    if not any(node_acl_group.wwns):
+    for wwn in members:
+        if tpg_lun.lun in topology.acls[wwn]['mapped'].values():
+            # Already masked.
+            return None
+
+    if not members:
         # Non-existent access group means volume mapping status will not be
         # stored. This should be considered as an error instead of silently
         # returning.
@@ -631,30 +1209,39 @@ def access_group_map_create(req, pool_name, vol_name, ag_name, h_lun_id=None):
         # Find out next available host LUN ID
         # Assuming max host LUN ID is MAX_LUN
         free_h_lun_ids = set(range(MAX_LUN+1)) - \
-            set([int(x.mapped_lun) for x in tpg_lun.mapped_luns])
+            set([int(mapped_lun) for acl in topology.acls.values()
+                 for mapped_lun, lun_index in acl['mapped'].items()
+                 if lun_index == tpg_lun.lun])
         if len(free_h_lun_ids) == 0:
             raise TargetdError(TargetdError.NO_FREE_HOST_LUN_ID,
                                "All host LUN ID 0 ~ %d is in use" % MAX_LUN)
         else:
             h_lun_id = free_h_lun_ids.pop()
 
-    node_acl_group.mapped_lun_group(h_lun_id, tpg_lun)
-    RTSRoot().save_to_file()
+    for wwn in members:
+        MappedLUN(NodeACL(tpg, wwn, mode='lookup'), h_lun_id, tpg_lun)
+        topology.acls[wwn]['mapped'][h_lun_id] = tpg_lun.lun
+    _save_config()
 
 
 def access_group_map_destroy(req, pool_name, vol_name, ag_name):
     tpg = _get_iscsi_tpg()
-    node_acl_group = NodeACLGroup(tpg, ag_name)
-    tpg_lun = _tpg_lun_of(tpg, pool_name, vol_name)
-    for map_group in node_acl_group.mapped_lun_groups:
-        if map_group.tpg_lun == tpg_lun:
-            map_group.delete()
-
-    if not any(tpg_lun.mapped_luns):
+    topology = lio_index.topology(tpg)
+    tpg_lun = _tpg_lun_of(tpg, topology, pool_name, vol_name)
+    for wwn in topology.group_members(ag_name):
+        mapped = topology.acls[wwn]['mapped']
+        for mapped_lun, lun_index in list(mapped.items()):
+            if lun_index == tpg_lun.lun:
+                MappedLUN(NodeACL(tpg, wwn, mode='lookup'),
+                          mapped_lun).delete()
+                del mapped[mapped_lun]
+
+    if not topology.is_mapped(tpg_lun.lun):
         # If LUN is not masked to any access group or initiator
         # remove LUN instance.
         lun_so = tpg_lun.storage_object
         tpg_lun.delete()
         lun_so.delete()
+        topology.remove_lun(tpg_lun.lun)
 
-    RTSRoot().save_to_file()
+    _save_config()
@@ -0,0 +1,690 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# btrfs subvolume drivers for the fs module.
+#
+# IoctlDriver talks to the kernel directly (the same ioctls btrfs-progs
+# uses), CliDriver runs the btrfs command.  Both offer:
+#
+#   create(path)                    new subvolume
+#   snapshot(source, dest, readonly)
+#   delete(path)
+#   delete_many(paths)
+#   list(pool)                      all subvolumes of the file system
+#   show(pool, path)                one subvolume, None if path isn't one
+#
+#   quota_enable(pool)
+#   qgroup_limit(path, size)        limit the referenced bytes of a subvolume
+#   qgroup_usage(pool)              {subvolume id: usage} of the pool
+#
+# Subvolumes are returned as dicts of id, path (relative to the top of the
+# file system, expected to be mounted as the pool), uuid, parent_uuid,
+# received_uuid and otime (creation time in seconds from epoch, only set for
+# snapshots and received subvolumes).  Usages are dicts of referenced and
+# exclusive bytes and limit (None without one).
+
+import errno
+import fcntl
+import os
+import struct
+import tempfile
+import uuid as uuid_mod
+import logging as log
+from subprocess import Popen, PIPE
+
+from targetd import metrics
+from targetd.utils import invoke, Backoff, TargetdError
+
+# From linux/btrfs.h and linux/btrfs_tree.h
+IOC_SUBVOL_CREATE = 0x5000940E
+IOC_SNAP_DESTROY = 0x5000940F
+IOC_SNAP_CREATE_V2 = 0x50009417
+IOC_TREE_SEARCH = 0xD0009411
+IOC_INO_LOOKUP = 0xD0009412
+IOC_QUOTA_CTL = 0xC0109428
+IOC_QGROUP_LIMIT = 0x8030942B
+
+ROOT_TREE_OBJECTID = 1
+QUOTA_TREE_OBJECTID = 8
+FS_TREE_OBJECTID = 5
+FIRST_FREE_OBJECTID = 256
+LAST_FREE_OBJECTID = 2**64 - 256
+ROOT_ITEM_KEY = 132
+ROOT_BACKREF_KEY = 144
+QGROUP_INFO_KEY = 242
+QGROUP_LIMIT_KEY = 244
+
+QUOTA_CTL_ENABLE = 1
+QGROUP_LIMIT_MAX_RFER = 1
+
+SUBVOL_RDONLY = 1 << 1
+
+# struct btrfs_ioctl_vol_args: fd, name[4088]
+_VOL_ARGS = struct.Struct('=q4088s')
+# struct btrfs_ioctl_vol_args_v2: fd, transid, flags, unused[4], name[4040]
+_VOL_ARGS_V2 = struct.Struct('=qQQ32x4040s')
+# struct btrfs_ioctl_search_key: tree_id, min/max objectid, min/max offset,
+# min/max transid, min/max type, nr_items, unused, unused1-4
+_SEARCH_KEY = struct.Struct('=7Q4I32x')
+_SEARCH_ARGS_SIZE = 4096
+# struct btrfs_ioctl_search_header: transid, objectid, offset, type, len
+_SEARCH_HEADER = struct.Struct('=3Q2I')
+# struct btrfs_ioctl_ino_lookup_args: treeid, objectid, name[4080]
+_INO_LOOKUP = struct.Struct('=QQ4080s')
+# struct btrfs_root_ref: dirid, sequence, name_len, followed by the name
+_ROOT_REF = struct.Struct('<QQH')
+# struct btrfs_ioctl_quota_ctl_args: cmd, status
+_QUOTA_CTL = struct.Struct('=QQ')
+# struct btrfs_ioctl_qgroup_limit_args: qgroupid, flags, max_rfer, max_excl,
+# rsv_rfer, rsv_excl
+_QGROUP_LIMIT = struct.Struct('=6Q')
+# struct btrfs_qgroup_info_item: generation, rfer, rfer_cmpr, excl, excl_cmpr
+_QGROUP_INFO = struct.Struct('<5Q')
+# struct btrfs_qgroup_limit_item: flags, max_rfer, max_excl, rsv_rfer,
+# rsv_excl
+_QGROUP_LIMIT_ITEM = struct.Struct('<5Q')
+
+# Offsets in struct btrfs_root_item
+_ROOT_ITEM_UUID = 247
+_ROOT_ITEM_PARENT_UUID = 263
+_ROOT_ITEM_RECEIVED_UUID = 279
+_ROOT_ITEM_OTIME = 339
+_ROOT_ITEM_MIN_SIZE = _ROOT_ITEM_OTIME + 12
+
+_U64_MAX = 2**64 - 1
+
+
+def _ioctl_error(what, path, e):
+    return TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
+                        "%s %s failed: %s" % (what, path, e.strerror))
+
+
+def _name_arg(name, size):
+    encoded = name.encode('utf-8')
+    if b'/' in encoded or len(encoded) >= size:
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "Invalid subvolume name %s" % name)
+    return encoded
+
+
+def _uuid(raw):
+    if raw == b'\0' * 16:
+        return None
+    return str(uuid_mod.UUID(bytes=raw))
+
+
+class _Fd(object):
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+    def __enter__(self):
+        return self.fd
+
+    def __exit__(self, *args):
+        os.close(self.fd)
+
+
+class IoctlDriver(object):
+    """
+    Subvolume operations through the btrfs ioctls, no process is started
+    """
+
+    name = 'ioctl'
+
+    def _ioctl(self, fd, request, buf, operation):
+        with metrics.timed('ioctl', operation):
+            fcntl.ioctl(fd, request, buf, True)
+
+    def create(self, path):
+        parent, name = os.path.split(path.rstrip(os.path.sep))
+        buf = bytearray(_VOL_ARGS.pack(0, _name_arg(name, 4088)))
+        try:
+            with _Fd(parent) as fd:
+                self._ioctl(fd, IOC_SUBVOL_CREATE, buf, 'subvol_create')
+        except OSError as e:
+            raise _ioctl_error("Creating subvolume", path, e)
+
+    def snapshot(self, source, dest, readonly=False):
+        parent, name = os.path.split(dest.rstrip(os.path.sep))
+        flags = SUBVOL_RDONLY if readonly else 0
+        try:
+            with _Fd(source) as source_fd, _Fd(parent) as fd:
+                buf = bytearray(_VOL_ARGS_V2.pack(
+                    source_fd, 0, flags, _name_arg(name, 4040)))
+                self._ioctl(fd, IOC_SNAP_CREATE_V2, buf, 'snap_create')
+        except OSError as e:
+            raise _ioctl_error("Snapshotting %s to" % source, dest, e)
+
+    def delete(self, path):
+        parent, name = os.path.split(path.rstrip(os.path.sep))
+        buf = bytearray(_VOL_ARGS.pack(0, _name_arg(name, 4088)))
+        try:
+            with _Fd(parent) as fd:
+                self._ioctl(fd, IOC_SNAP_DESTROY, buf, 'snap_destroy')
+        except OSError as e:
+            raise _ioctl_error("Deleting subvolume", path, e)
+
+    def delete_many(self, paths):
+        for path in paths:
+            self.delete(path)
+
+    def _search(self, fd, min_objectid, max_objectid, min_type, max_type,
+                tree_id=ROOT_TREE_OBJECTID):
+        """
+        Yields (objectid, type, offset, data) of the items of tree tree_id
+        within the given key ranges
+        """
+        key = [min_objectid, 0, min_type]
+        while True:
+            buf = bytearray(_SEARCH_ARGS_SIZE)
+            _SEARCH_KEY.pack_into(
+                buf, 0, tree_id, key[0], max_objectid, key[1],
+                _U64_MAX, 0, _U64_MAX, key[2], max_type, 4096, 0)
+            self._ioctl(fd, IOC_TREE_SEARCH, buf, 'tree_search')
+
+            nr_items = _SEARCH_KEY.unpack_from(buf, 0)[9]
+            if nr_items == 0:
+                return
+
+            pos = _SEARCH_KEY.size
+            for i in range(nr_items):
+                transid, objectid, offset, item_type, length = \
+                    _SEARCH_HEADER.unpack_from(buf, pos)
+                pos += _SEARCH_HEADER.size
+                # The search range is compared as a whole (objectid, type,
+                # offset) key, other item types may come along
+                if min_type <= item_type <= max_type:
+                    yield objectid, item_type, offset, bytes(
+                        buf[pos:pos + length])
+                pos += length
+
+            # Continue after the last item
+            if offset < _U64_MAX:
+                key = [objectid, offset + 1, item_type]
+            elif item_type < 255:
+                key = [objectid, 0, item_type + 1]
+            elif objectid < max_objectid:
+                key = [objectid + 1, 0, 0]
+            else:
+                return
+
+    @staticmethod
+    def _root_item(objectid, offset, data):
+        if len(data) < _ROOT_ITEM_MIN_SIZE:
+            # written by a kernel before 3.6, without uuids and times
+            return dict(id=objectid, uuid=None, parent_uuid=None,
+                        received_uuid=None, otime=None)
+        received_uuid = _uuid(
+            data[_ROOT_ITEM_RECEIVED_UUID:_ROOT_ITEM_RECEIVED_UUID + 16])
+        otime = None
+        # like 'btrfs subvolume list -s', snapshots have a non zero offset
+        if offset or received_uuid:
+            otime = struct.unpack_from('<Q', data, _ROOT_ITEM_OTIME)[0]
+        return dict(
+            id=objectid,
+            uuid=_uuid(data[_ROOT_ITEM_UUID:_ROOT_ITEM_UUID + 16]),
+            parent_uuid=_uuid(
+                data[_ROOT_ITEM_PARENT_UUID:_ROOT_ITEM_PARENT_UUID + 16]),
+            received_uuid=received_uuid,
+            otime=otime)
+
+    def _ino_path(self, fd, tree_id, objectid):
+        """
+        Path of directory objectid inside subvolume tree_id, '' or ending
+        with a '/'
+        """
+        buf = bytearray(_INO_LOOKUP.pack(tree_id, objectid, b''))
+        self._ioctl(fd, IOC_INO_LOOKUP, buf, 'ino_lookup')
+        name = _INO_LOOKUP.unpack_from(buf, 0)[2]
+        return name.split(b'\0', 1)[0].decode('utf-8', 'surrogateescape')
+
+    def list(self, pool):
+        roots = {}
+        refs = {}
+        try:
+            with _Fd(pool) as fd:
+                for objectid, item_type, offset, data in self._search(
+                        fd, FIRST_FREE_OBJECTID, LAST_FREE_OBJECTID,
+                        ROOT_ITEM_KEY, ROOT_BACKREF_KEY):
+                    if item_type == ROOT_ITEM_KEY:
+                        roots[objectid] = self._root_item(
+                            objectid, offset, data)
+                    elif item_type == ROOT_BACKREF_KEY:
+                        dirid, sequence, name_len = _ROOT_REF.unpack_from(
+                            data, 0)
+                        name = data[_ROOT_REF.size:_ROOT_REF.size + name_len]
+                        refs[objectid] = (
+                            offset, dirid,
+                            name.decode('utf-8', 'surrogateescape'))
+
+                paths = {FS_TREE_OBJECTID: ''}
+                dirs = {}
+
+                def _path(subvol_id):
+                    if subvol_id not in paths:
+                        parent, dirid, name = refs[subvol_id]
+                        if (parent, dirid) not in dirs:
+                            dirs[(parent, dirid)] = self._ino_path(
+                                fd, parent, dirid)
+                        paths[subvol_id] = os.path.join(
+                            _path(parent), dirs[(parent, dirid)], name)
+                    return paths[subvol_id]
+
+                rc = []
+                for subvol_id in sorted(roots):
+                    # a deleted subvolume waiting to be cleaned up has no
+                    # reference left
+                    if subvol_id not in refs:
+                        continue
+                    try:
+                        path = _path(subvol_id)
+                    except (KeyError, OSError):
+                        continue
+                    entry = dict(roots[subvol_id])
+                    entry['path'] = path
+                    rc.append(entry)
+                return rc
+        except OSError as e:
+            raise _ioctl_error("Listing subvolumes of", pool, e)
+
+    def show(self, pool, path):
+        try:
+            if os.stat(path).st_ino != FIRST_FREE_OBJECTID:
+                return None
+            with _Fd(path) as fd:
+                # tree id 0 looks up the subvolume fd is in
+                buf = bytearray(_INO_LOOKUP.pack(0, FIRST_FREE_OBJECTID, b''))
+                self._ioctl(fd, IOC_INO_LOOKUP, buf, 'ino_lookup')
+                subvol_id = _INO_LOOKUP.unpack_from(buf, 0)[0]
+                for objectid, item_type, offset, data in self._search(
+                        fd, subvol_id, subvol_id, ROOT_ITEM_KEY,
+                        ROOT_ITEM_KEY):
+                    entry = self._root_item(objectid, offset, data)
+                    entry['path'] = os.path.relpath(path, pool)
+                    return entry
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise _ioctl_error("Looking up subvolume", path, e)
+        return None
+
+    def quota_enable(self, pool):
+        buf = bytearray(_QUOTA_CTL.pack(QUOTA_CTL_ENABLE, 0))
+        try:
+            with _Fd(pool) as fd:
+                self._ioctl(fd, IOC_QUOTA_CTL, buf, 'quota_ctl')
+        except OSError as e:
+            raise _ioctl_error("Enabling quotas on", pool, e)
+
+    def qgroup_limit(self, path, size):
+        # qgroup id 0 is the one of the subvolume path
+        buf = bytearray(_QGROUP_LIMIT.pack(0, QGROUP_LIMIT_MAX_RFER, size,
+                                           0, 0, 0))
+        try:
+            with _Fd(path) as fd:
+                self._ioctl(fd, IOC_QGROUP_LIMIT, buf, 'qgroup_limit')
+        except OSError as e:
+            raise _ioctl_error("Limiting", path, e)
+
+    def qgroup_usage(self, pool):
+        rc = {}
+        try:
+            with _Fd(pool) as fd:
+                for objectid, item_type, offset, data in self._search(
+                        fd, 0, 0, QGROUP_INFO_KEY, QGROUP_LIMIT_KEY,
+                        tree_id=QUOTA_TREE_OBJECTID):
+                    # level 0 qgroups are the subvolumes, their id in the
+                    # lower 48 bits
+                    if offset >> 48:
+                        continue
+                    usage = rc.setdefault(offset, dict(
+                        referenced=0, exclusive=0, limit=None))
+                    if item_type == QGROUP_INFO_KEY:
+                        generation, rfer, rfer_cmpr, excl, excl_cmpr = \
+                            _QGROUP_INFO.unpack_from(data, 0)
+                        usage['referenced'] = rfer
+                        usage['exclusive'] = excl
+                    elif item_type == QGROUP_LIMIT_KEY:
+                        flags, max_rfer = \
+                            _QGROUP_LIMIT_ITEM.unpack_from(data, 0)[:2]
+                        if flags & QGROUP_LIMIT_MAX_RFER:
+                            usage['limit'] = max_rfer
+        except OSError as e:
+            # ENOENT: quotas aren't enabled
+            if e.errno == errno.ENOENT:
+                return {}
+            raise _ioctl_error("Reading the qgroups of", pool, e)
+        return rc
+
+    def probe(self, pool):
+        """
+        Raises OSError when the ioctls can't be used on pool
+        """
+        with _Fd(pool) as fd:
+            for item in self._search(fd, FS_TREE_OBJECTID, FS_TREE_OBJECTID,
+                                     ROOT_ITEM_KEY, ROOT_ITEM_KEY):
+                break
+
+
+# Keys of the 'btrfs subvolume list' output in the order they are printed,
+# with the number of words of their value (0: the rest of the line)
+_LIST_KEYS = (('ID', 1), ('gen', 1), ('cgen', 1), ('parent', 1),
+              ('top level', 1), ('otime', 2), ('parent_uuid', 1),
+              ('received_uuid', 1), ('uuid', 1), ('path', 0))
+
+
+def parse_subvolume_list(out):
+    """
+    Parse the output of 'btrfs subvolume list' into a list of {key: value}
+    dicts, whatever columns were asked for.  Paths are relative to the top of
+    the file system and may contain spaces, values of '-' (no uuid) are None.
+    """
+    strip_it = '<FS_TREE>/'
+
+    rc = []
+    for line in out.split('\n'):
+        words = line.split(' ')
+        entry = {}
+        i = 0
+        while i < len(words):
+            for key, size in _LIST_KEYS:
+                key_words = key.split(' ')
+                if words[i:i + len(key_words)] != key_words:
+                    continue
+                i += len(key_words)
+                if size == 0:
+                    size = len(words) - i
+                value = ' '.join(words[i:i + size])
+                entry[key] = None if value == '-' else value
+                i += size
+                break
+            else:
+                # Skip over a column we don't know about
+                i += 1
+
+        if entry.get('path') is not None:
+            if entry['path'].startswith(strip_it):
+                entry['path'] = entry['path'][len(strip_it):]
+            rc.append(entry)
+    return rc
+
+
+# btrfs prints times in the local time zone, it is run in UTC so they convert
+# to seconds from epoch without time zone rules
+_UTC = dict(TZ='UTC')
+
+# 'YYYY-MM-DD' -> days from epoch, snapshots share few distinct days
+_epoch_days = {}
+_EPOCH_DAYS_MAX = 4096
+
+
+def _days_from_civil(year, month, day):
+    # days since 1970-01-01 of a proleptic Gregorian date, see
+    # http://howardhinnant.github.io/date_algorithms.html#days_from_civil
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def utc_seconds(text):
+    """
+    Seconds from epoch of a 'YYYY-MM-DD HH:MM:SS' UTC time, optionally
+    followed by a ' +HHMM' offset as 'btrfs subvolume show' prints
+    """
+    day = text[:10]
+    days = _epoch_days.get(day)
+    if days is None:
+        days = _days_from_civil(int(text[0:4]), int(text[5:7]),
+                                int(text[8:10]))
+        if len(_epoch_days) >= _EPOCH_DAYS_MAX:
+            _epoch_days.clear()
+        _epoch_days[day] = days
+
+    rc = days * 86400 + int(text[11:13]) * 3600 + int(text[14:16]) * 60 + \
+        int(text[17:19])
+    if len(text) >= 25:
+        offset = int(text[21:23]) * 3600 + int(text[23:25]) * 60
+        rc += offset if text[20] == '-' else -offset
+    return rc
+
+
+def parse_subvolume_otimes(out):
+    """
+    {path: otime} of the output of 'btrfs subvolume list -a -s' run in UTC.
+    Faster than parse_subvolume_list() for the many lines of the snapshots
+    of a pool: only the otime and path columns are looked at.
+    """
+    strip_it = '<FS_TREE>/'
+    rc = {}
+    for line in out.split('\n'):
+        # path is the last column and may contain anything
+        head, sep, path = line.partition(' path ')
+        i = head.find(' otime ')
+        if not sep or i < 0:
+            continue
+        if path.startswith(strip_it):
+            path = path[len(strip_it):]
+        rc[path] = utc_seconds(head[i + 7:i + 26])
+    return rc
+
+
+# 'btrfs subvolume list' racing with a subvolume deletion fails with
+# ERROR: Failed to lookup path for root 0 - No such file or directory
+_LOOKUP_RACE_EXIT_CODE = 19
+
+# Retry policy of the list commands, set up from the fs_retry_* settings
+retry = Backoff()
+
+
+def _invoke_retries(command, env=None):
+    result, out, err = retry.call(
+        metrics.invoke_operation(command),
+        lambda: invoke(command, False, env),
+        lambda rc: rc[0] == _LOOKUP_RACE_EXIT_CODE)
+
+    if result == _LOOKUP_RACE_EXIT_CODE:
+        raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
+                           "Unable to execute command after "
+                           "multiple retries %s" % (str(command)))
+    if result != 0:
+        raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
+                           "Unexpected exit code %d" % result)
+    return result, out, err
+
+
+class CliDriver(object):
+    """
+    Subvolume operations through the btrfs command
+    """
+
+    name = 'cli'
+    cmd = 'btrfs'
+
+    def create(self, path):
+        invoke([self.cmd, 'subvolume', 'create', path])
+
+    def snapshot(self, source, dest, readonly=False):
+        args = [self.cmd, 'subvolume', 'snapshot']
+        if readonly:
+            args.append('-r')
+        invoke(args + [source, dest])
+
+    def delete(self, path):
+        invoke([self.cmd, 'subvolume', 'delete', path])
+
+    def delete_many(self, paths):
+        invoke([self.cmd, 'subvolume', 'delete'] + list(paths))
+
+    def list(self, pool):
+        rc = []
+        by_path = {}
+
+        result, out, err = _invoke_retries(
+            [self.cmd, 'subvolume', 'list', '-a', '-u', '-q', '-R', pool])
+        for e in parse_subvolume_list(out):
+            entry = dict(id=int(e['ID']), path=e['path'],
+                         uuid=e.get('uuid'),
+                         parent_uuid=e.get('parent_uuid'),
+                         received_uuid=e.get('received_uuid'), otime=None)
+            rc.append(entry)
+            by_path[entry['path']] = entry
+
+        # Only snapshots are listed with their creation time
+        if any(e['parent_uuid'] is not None for e in rc):
+            result, out, err = _invoke_retries(
+                [self.cmd, 'subvolume', 'list', '-a', '-s', pool], _UTC)
+            for path, otime in parse_subvolume_otimes(out).items():
+                entry = by_path.get(path)
+                if entry is not None:
+                    entry['otime'] = otime
+
+        # A fully received subvolume isn't a snapshot to btrfs, there are few
+        # of them: the first replica of each file system
+        for entry in rc:
+            if entry['received_uuid'] is not None and entry['otime'] is None:
+                shown = self.show(pool, os.path.join(pool, entry['path']))
+                if shown is not None:
+                    entry['otime'] = shown['otime']
+
+        return rc
+
+    def show(self, pool, path):
+        result, out, err = invoke([self.cmd, 'subvolume', 'show', path],
+                                  False, _UTC)
+        if result != 0:
+            return None
+
+        fields = {}
+        for line in out.split('\n')[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                value = value.strip()
+                fields[key.strip()] = None if value == '-' else value
+
+        otime = None
+        if (fields.get('Parent UUID') is not None or
+                fields.get('Received UUID') is not None) and \
+                fields.get('Creation time') is not None:
+            otime = utc_seconds(fields['Creation time'])
+        subvol_id = fields.get('Subvolume ID')
+        return dict(id=int(subvol_id) if subvol_id else None,
+                    path=os.path.relpath(path, pool),
+                    uuid=fields.get('UUID'),
+                    parent_uuid=fields.get('Parent UUID'),
+                    received_uuid=fields.get('Received UUID'),
+                    otime=otime)
+
+    def quota_enable(self, pool):
+        invoke([self.cmd, 'quota', 'enable', pool])
+
+    def qgroup_limit(self, path, size):
+        invoke([self.cmd, 'qgroup', 'limit', str(size), path])
+
+    def qgroup_usage(self, pool):
+        result, out, err = invoke(
+            [self.cmd, 'qgroup', 'show', '--raw', '-r', pool], False)
+        if result != 0:
+            # quotas aren't enabled
+            return {}
+        return parse_qgroup_show(out)
+
+
+def parse_qgroup_show(out):
+    """
+    Parse the output of 'btrfs qgroup show --raw -r' into {subvolume id:
+    usage} for the level 0 qgroups, skipping the header lines.  Newer
+    btrfs-progs print a path column after the ones we read.
+    """
+    rc = {}
+    for line in out.split('\n'):
+        words = line.split()
+        if len(words) < 4 or '/' not in words[0]:
+            continue
+        level, qgroup_id = words[0].split('/', 1)
+        if level != '0' or not qgroup_id.isdigit():
+            continue
+        rc[int(qgroup_id)] = dict(
+            referenced=int(words[1]), exclusive=int(words[2]),
+            limit=int(words[3]) if words[3].isdigit() else None)
+    return rc
+
+
+def send_receive(source, dest_dir, parent=None):
+    """
+    Copy the read only subvolume source into directory dest_dir with
+    'btrfs send | btrfs receive', incrementally from parent (a subvolume
+    already received there) if given.  The stream goes straight from one
+    process to the other.  Both drivers use the commands, the send stream
+    is produced and applied by btrfs-progs.
+    """
+    send_cmd = [CliDriver.cmd, 'send']
+    if parent is not None:
+        send_cmd += ['-p', parent]
+    send_cmd.append(source)
+    receive_cmd = [CliDriver.cmd, 'receive', dest_dir]
+
+    with metrics.timed('invoke', 'btrfs send|receive'), \
+            tempfile.TemporaryFile() as send_err:
+        # send's stderr goes to a file so neither side can block on a full
+        # pipe while we wait for receive
+        send = Popen(send_cmd, stdout=PIPE, stderr=send_err)
+        try:
+            receive = Popen(receive_cmd, stdin=send.stdout, stdout=PIPE,
+                            stderr=PIPE)
+        except OSError:
+            send.kill()
+            send.wait()
+            raise
+        finally:
+            # receive holds the read end, send gets SIGPIPE if it goes away
+            send.stdout.close()
+        out, err = receive.communicate()
+        send.wait()
+
+        if send.returncode != 0 or receive.returncode != 0:
+            send_err.seek(0)
+            raise TargetdError(
+                TargetdError.UNEXPECTED_EXIT_CODE,
+                'Unexpected exit code "%s" %d | "%s" %d, err= %s' % (
+                    ' '.join(send_cmd), send.returncode,
+                    ' '.join(receive_cmd), receive.returncode,
+                    (send_err.read() + err).decode('utf-8', 'replace')))
+
+
+def get_driver(name, pools):
+    """
+    Return the driver configured with fs_driver: 'ioctl', 'cli' or 'auto',
+    the ioctls when they work on every pool and else the command.
+    """
+    if name == 'cli':
+        return CliDriver()
+    if name == 'ioctl':
+        return IoctlDriver()
+    if name != 'auto':
+        raise TargetdError(TargetdError.INVALID,
+                           "Unknown fs_driver %s" % name)
+
+    driver = IoctlDriver()
+    for pool in pools:
+        try:
+            driver.probe(pool)
+        except OSError as e:
+            log.info("btrfs ioctls unusable on %s (%s), using the btrfs "
+                     "command" % (pool, e.strerror))
+            return CliDriver()
+    return driver
@@ -16,10 +16,14 @@
 #
 # fs support using btrfs.
 
+import functools
 import os
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from targetd import btrfs, jobs
 from targetd.nfs import Nfs, Export
-from targetd.utils import invoke, TargetdError
+from targetd.utils import ignored, TargetdError, locked, select, \
+    resource_locks
 
 # Notes:
 #
@@ -42,15 +46,89 @@ import logging as log
 
 fs_path = "targetd_fs"
 ss_path = "targetd_ss"
-fs_cmd = 'btrfs'
 
 pools = []
 
+# btrfs.IoctlDriver or btrfs.CliDriver, see the fs_driver setting
+driver = btrfs.CliDriver()
+
+# Number of snapshots fs_snapshot_bulk creates at the same time
+snapshot_workers = 16
+
+# Most subvolumes removed by one 'btrfs subvolume delete'
+DELETE_BATCH = 64
+
+# Whether btrfs quotas are used to limit and account the file systems, see
+# the fs_quota setting
+quota = False
+
+# Lock protecting the NFS export tables and our exports file
+NFS_LOCK = "nfs"
+
+
+def _pool_lock(pool_name):
+    return "fs:%s" % pool_name
+
+
+def _arg_pool_lock(kwargs):
+    pool_name = kwargs.get('pool_name')
+    if pool_name not in pools:
+        return None
+    return _pool_lock(pool_name)
+
+
+def pool_locks(kwargs=None):
+    """
+    Lock names of every configured fs pool.  Calls addressing a file system by
+    uuid can't know its pool before looking it up, so they lock all fs pools.
+    """
+    return [_pool_lock(p) for p in pools]
+
+
+def _fs_pool_lock(kwargs):
+    """
+    Lock name of the pool of file system fs_uuid (or uuid).  It is looked
+    up without the pool locks, which a long call on another pool may hold,
+    the subvolume index is safe to read; the call checks again that the
+    file system is there once it holds the lock.
+    """
+    fs_ht = _get_fs_by_uuid(None, kwargs.get('fs_uuid', kwargs.get('uuid')))
+    return _pool_lock(fs_ht['pool']) if fs_ht else None
+
+
+def _snapshots_pool_locks(kwargs):
+    """
+    Lock names of the pools of the file systems in the snapshots list of
+    fs_snapshot_bulk, looked up like _fs_pool_lock()
+    """
+    snapshots = kwargs.get('snapshots')
+    if not isinstance(snapshots, list):
+        return None
+    fs_uuids = set(s.get('fs_uuid') for s in snapshots if isinstance(s, dict))
+    return [_pool_lock(p) for p in pools
+            if not fs_uuids.isdisjoint(subvolume_index.pool(p).by_uuid)]
+
+
+def _dest_pool_lock(kwargs):
+    dest_pool = kwargs.get('dest_pool')
+    if dest_pool not in pools:
+        return None
+    return _pool_lock(dest_pool)
+
 
 def initialize(config_dict):
 
     global pools
+    global driver
+    global quota
+    global snapshot_workers
     pools = config_dict['fs_pools']
+    snapshot_workers = config_dict['max_workers']
+    quota = config_dict['fs_quota']
+    btrfs.retry.attempts = config_dict['fs_retry_attempts']
+    btrfs.retry.max_delay = config_dict['fs_retry_max_delay']
+    driver = btrfs.get_driver(config_dict['fs_driver'], pools)
+    log.info("Using the btrfs %s driver" % driver.name)
 
     for pool in pools:
         # Make sure we have the appropriate subvolumes available
@@ -61,44 +139,177 @@ def initialize(config_dict):
             log.error('Unable to create required subvolumes {0}'.format(e))
             raise
 
+        if quota:
+            try:
+                driver.quota_enable(pool)
+            except TargetdError as e:
+                log.error('Unable to enable quotas on {0}: {1}'.format(
+                    pool, e))
+                raise
+
     return dict(
-        fs_list=fs,
-        fs_destroy=fs_destroy,
-        fs_create=fs_create,
-        fs_clone=fs_clone,
-        ss_list=ss,
-        fs_snapshot=fs_snapshot,
-        fs_snapshot_delete=fs_snapshot_delete,
+        fs_list=locked(fs, reads=[pool_locks]),
+        fs_get=locked(fs_get, reads=[pool_locks]),
+        fs_destroy=locked(fs_destroy, writes=[_fs_pool_lock]),
+        fs_create=locked(fs_create, writes=[_arg_pool_lock]),
+        fs_clone=locked(fs_clone, writes=[_fs_pool_lock]),
+        ss_list=locked(ss, reads=[pool_locks]),
+        fs_snapshot=locked(fs_snapshot, writes=[_fs_pool_lock]),
+        fs_snapshot_bulk=locked(fs_snapshot_bulk,
+                                writes=[_snapshots_pool_locks]),
+        fs_replicate=locked(fs_replicate, reads=[_fs_pool_lock],
+                            writes=[_dest_pool_lock]),
+        fs_snapshot_delete=locked(fs_snapshot_delete,
+                                  writes=[_fs_pool_lock]),
         nfs_export_auth_list=nfs_export_auth_list,
-        nfs_export_list=nfs_export_list,
-        nfs_export_add=nfs_export_add,
-        nfs_export_remove=nfs_export_remove,
+        nfs_export_list=locked(nfs_export_list, reads=[NFS_LOCK]),
+        nfs_export_add=locked(nfs_export_add, writes=[NFS_LOCK]),
+        nfs_export_remove=locked(nfs_export_remove, writes=[NFS_LOCK]),
+        nfs_export_add_bulk=locked(nfs_export_add_bulk, writes=[NFS_LOCK]),
+        nfs_export_remove_bulk=locked(nfs_export_remove_bulk,
+                                      writes=[NFS_LOCK]),
     )
 
 
 def create_sub_volume(p):
     if not os.path.exists(p):
-        invoke([fs_cmd, 'subvolume', 'create', p])
+        driver.create(p)
 
 
-def split_stdout(out):
+class _PoolSubvolumes(object):
     """
-    Split the text out as an array of text arrays.
+    Subvolumes of one fs pool, see SubvolumeIndex.  Entries are dicts of
+    path (relative to the pool), uuid, parent_uuid, received_uuid and otime
+    (seconds from epoch, None for subvolumes which aren't snapshots).
     """
-    strip_it = '<FS_TREE>/'
 
-    rc = []
-    for line in out.split('\n'):
-        elem = line.split(' ')
-        if len(elem) > 1:
-            tmp = []
-            for z in elem:
-                if z.startswith(strip_it):
-                    tmp.append(z[len(strip_it):])
-                else:
-                    tmp.append(z)
-            rc.append(tmp)
-    return rc
+    def __init__(self):
+        self.by_path = {}
+        self.by_uuid = {}
+
+    def add(self, entry):
+        self.remove(entry['path'])
+        self.by_path[entry['path']] = entry
+        if entry['uuid'] is not None:
+            self.by_uuid[entry['uuid']] = entry
+
+    def remove(self, path):
+        entry = self.by_path.pop(path, None)
+        if entry is not None and \
+                self.by_uuid.get(entry['uuid']) is entry:
+            del self.by_uuid[entry['uuid']]
+
+    def children(self, parent_dir):
+        """
+        Yields (name, entry) of the subvolumes directly below parent_dir
+        """
+        prefix = parent_dir + os.path.sep
+        for path, entry in self.by_path.items():
+            if path.startswith(prefix) and \
+                    os.path.sep not in path[len(prefix):]:
+                yield path[len(prefix):], entry
+
+
+class SubvolumeIndex(object):
+    """
+    Per pool index of the btrfs subvolumes by path and uuid, so fs calls
+    don't run 'btrfs subvolume list' over the whole pool each time.
+
+    Subvolumes created and deleted by targetd are recorded as it goes.  Any
+    done by someone else changes the mtime of targetd_fs, targetd_ss or one
+    of the targetd_ss/<fs> directories, which are compared on every use, and
+    the pool is listed again.
+
+    Callers hold the pool lock: shared to read, exclusive to change the pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # pool -> (signature, _PoolSubvolumes)
+        self._pools = {}
+        self._pool_locks = {}
+
+    def _pool_lock(self, pool):
+        with self._lock:
+            if pool not in self._pool_locks:
+                self._pool_locks[pool] = threading.Lock()
+            return self._pool_locks[pool]
+
+    @staticmethod
+    def _signature(pool):
+        rc = []
+        for d in (fs_path, ss_path):
+            with ignored(OSError):
+                rc.append((d, os.stat(os.path.join(pool, d)).st_mtime_ns))
+        with ignored(OSError):
+            for e in os.scandir(os.path.join(pool, ss_path)):
+                if e.is_dir(follow_symlinks=False):
+                    rc.append((os.path.join(ss_path, e.name),
+                               e.stat(follow_symlinks=False).st_mtime_ns))
+        return tuple(sorted(rc))
+
+    @staticmethod
+    def _scan(pool):
+        subvolumes = _PoolSubvolumes()
+        for entry in driver.list(pool):
+            subvolumes.add(entry)
+        return subvolumes
+
+    def pool(self, pool):
+        """
+        Returns the _PoolSubvolumes of pool, listed again first when it
+        changed behind our back.
+        """
+        with self._pool_lock(pool):
+            signature = self._signature(pool)
+            cached = self._pools.get(pool)
+            if cached is None or cached[0] != signature:
+                if cached is not None:
+                    log.debug("Listing subvolumes of %s again", pool)
+                cached = (signature, self._scan(pool))
+                self._pools[pool] = cached
+            return cached[1]
+
+    def added(self, pool, path, entry=None):
+        """
+        Record the subvolume targetd just created at path (relative to pool),
+        entry is what driver.show() returned for it if already known.
+        """
+        with self._pool_lock(pool):
+            cached = self._pools.get(pool)
+            if cached is None:
+                return
+
+            if entry is None:
+                entry = driver.show(pool, os.path.join(pool, path))
+            if entry is None:
+                del self._pools[pool]
+                return
+
+            entry['path'] = path
+            cached[1].add(entry)
+            self._pools[pool] = (self._signature(pool), cached[1])
+
+    def removed(self, pool, path):
+        """
+        Record that targetd deleted the subvolume at path (relative to pool)
+        """
+        with self._pool_lock(pool):
+            cached = self._pools.get(pool)
+            if cached is None:
+                return
+            cached[1].remove(path)
+            self._pools[pool] = (self._signature(pool), cached[1])
+
+    def invalidate(self, pool=None):
+        with self._lock:
+            if pool is None:
+                self._pools.clear()
+            else:
+                self._pools.pop(pool, None)
+
+
+subvolume_index = SubvolumeIndex()
 
 
 def fs_space_values(mount_point):
@@ -128,7 +339,14 @@ def fs_create(req, pool_name, name, size_bytes):
     full_path = os.path.join(pool_name, fs_path, name)
 
     if not os.path.exists(full_path):
-        invoke([fs_cmd, 'subvolume', 'create', full_path])
+        driver.create(full_path)
+        if quota and size_bytes:
+            try:
+                driver.qgroup_limit(full_path, size_bytes)
+            except TargetdError:
+                driver.delete(full_path)
+                raise
+        subvolume_index.added(pool_name, os.path.join(fs_path, name))
     else:
         raise TargetdError(TargetdError.EXISTS_FS_NAME, 'FS already exists')
 
@@ -147,38 +365,218 @@ def fs_snapshot(req, fs_uuid, dest_ss_name):
             raise TargetdError(TargetdError.EXISTS_FS_NAME,
                                "Snapshot already exists with that name")
 
-        invoke([fs_cmd, 'subvolume', 'snapshot', '-r', source_path, dest_path])
+        driver.snapshot(source_path, dest_path, readonly=True)
+        subvolume_index.added(
+            fs_ht['pool'], os.path.join(ss_path, fs_ht['name'], dest_ss_name))
+
+
+def _snapshot_one(pool, fs_name, dest_ss_name):
+    relpath = os.path.join(ss_path, fs_name, dest_ss_name)
+    dest_path = os.path.join(pool, relpath)
+    driver.snapshot(os.path.join(pool, fs_path, fs_name), dest_path,
+                    readonly=True)
+    # the new subvolume may not be found right away, like other lookups
+    entry = btrfs.retry.call('btrfs subvolume show',
+                             lambda: driver.show(pool, dest_path),
+                             lambda e: e is None)
+    if entry is None:
+        # it was created all the same, list the pool again on next use
+        log.warning("Snapshot %s created but not found" % relpath)
+        subvolume_index.invalidate(pool)
+        return None
+    subvolume_index.added(pool, relpath, entry)
+    return entry['uuid']
+
+
+def fs_snapshot_bulk(req, snapshots):
+    """
+    Snapshot many file systems at once, snapshots is a list of {fs_uuid,
+    dest_ss_name}.  The file systems are looked up together and the
+    snapshots created concurrently.  Returns one {fs_uuid, dest_ss_name}
+    result per item, in order, with the new snapshot uuid or an error.  The
+    uuid is None for a snapshot created but not found afterwards.
+    """
+    if not isinstance(snapshots, list):
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "snapshots must be a list")
+
+    file_systems = {}
+    for pool in pools:
+        for name, entry in subvolume_index.pool(pool).children(fs_path):
+            file_systems[entry['uuid']] = (pool, name)
+
+    results = []
+    todo = {}
+    dest_paths = set()
+    for i, item in enumerate(snapshots):
+        if not isinstance(item, dict):
+            item = {}
+        fs_uuid = item.get('fs_uuid')
+        dest_ss_name = item.get('dest_ss_name')
+        rc = dict(fs_uuid=fs_uuid, dest_ss_name=dest_ss_name)
+        results.append(rc)
+
+        if fs_uuid is None or not dest_ss_name:
+            rc['error'] = dict(code=TargetdError.INVALID_ARGUMENT,
+                               message="fs_uuid and dest_ss_name are "
+                                       "required")
+            continue
+        if fs_uuid not in file_systems:
+            rc['error'] = dict(code=TargetdError.NOT_FOUND_FS,
+                               message="fs_uuid not found")
+            continue
+
+        pool, fs_name = file_systems[fs_uuid]
+        dest_path = os.path.join(pool, ss_path, fs_name, dest_ss_name)
+        if dest_path in dest_paths or os.path.exists(dest_path):
+            rc['error'] = dict(code=TargetdError.EXISTS_FS_NAME,
+                               message="Snapshot already exists with that "
+                                       "name")
+            continue
+        dest_paths.add(dest_path)
+        todo[i] = (pool, fs_name, dest_ss_name)
+
+    # The per file system snapshot directories first, several snapshots may
+    # go to the same one
+    for i, (pool, fs_name, dest_ss_name) in list(todo.items()):
+        try:
+            create_sub_volume(os.path.join(pool, ss_path, fs_name))
+        except TargetdError as e:
+            results[i]['error'] = dict(code=e.error, message=str(e))
+            del todo[i]
+
+    if todo:
+        with ThreadPoolExecutor(
+                max_workers=min(snapshot_workers, len(todo))) as executor:
+            futures = dict((i, executor.submit(_snapshot_one, *args))
+                           for i, args in todo.items())
+            for i, future in futures.items():
+                try:
+                    results[i]['uuid'] = future.result()
+                except TargetdError as e:
+                    results[i]['error'] = dict(code=e.error, message=str(e))
+                except Exception as e:
+                    log.error("Snapshot %s failed: %s" % (todo[i], e))
+                    results[i]['error'] = dict(
+                        code=-1, message="%s: %s" % (type(e).__name__, e))
+
+    return results
+
+
+def _in_background(method, func, total, reads=(), writes=(),
+                   lane='default'):
+    """
+    Queue func(job) as a background job holding the reads and writes fs
+    pool locks, func looks up again what it works on as things may have
+    changed meanwhile.
+    """
+    def _run(job):
+        with resource_locks.hold(reads, writes):
+            return func(job)
+
+    return jobs.queue.submit(method, _run, total, lane)
 
 
-def fs_snapshot_delete(req, fs_uuid, ss_uuid):
+def _snapshot_path(req, fs_uuid, ss_uuid):
+    """
+    (pool, path relative to pool) of snapshot ss_uuid of file system fs_uuid
+    """
     fs_ht = _get_fs_by_uuid(req, fs_uuid)
+    if not fs_ht:
+        raise TargetdError(TargetdError.NOT_FOUND_FS, "fs_uuid not found")
+
     snapshot = _get_ss_by_uuid(req, fs_uuid, ss_uuid, fs_ht)
-    path = os.path.join(fs_ht['pool'], ss_path, fs_ht['name'],
-                        snapshot['name'])
-    fs_subvolume_delete(path)
+    if not snapshot:
+        raise TargetdError(TargetdError.NOT_FOUND_SS, "snapshot not found")
+
+    return fs_ht['pool'], os.path.join(ss_path, fs_ht['name'],
+                                       snapshot['name'])
+
+
+def fs_snapshot_delete(req, fs_uuid, ss_uuid, background=False):
+    pool, path = _snapshot_path(req, fs_uuid, ss_uuid)
+
+    if background:
+        def _job(job):
+            pool, path = _snapshot_path(req, fs_uuid, ss_uuid)
+            _delete_many(pool, [path], job)
+
+        return _in_background('fs_snapshot_delete', _job, 1,
+                              writes=[_pool_lock(pool)])
+
+    _delete(pool, path)
 
 
 def fs_subvolume_delete(path):
-    invoke([fs_cmd, 'subvolume', 'delete', path])
+    driver.delete(path)
+
+
+def _delete(pool, path):
+    """
+    Delete the subvolume at path (relative to pool)
+    """
+    fs_subvolume_delete(os.path.join(pool, path))
+    subvolume_index.removed(pool, path)
 
 
-def fs_destroy(req, uuid):
+def _delete_many(pool, paths, job=None):
+    """
+    Delete the subvolumes at paths (relative to pool), DELETE_BATCH at a
+    time.  None of them may be below another one.
+    """
+    for i in range(0, len(paths), DELETE_BATCH):
+        batch = paths[i:i + DELETE_BATCH]
+        driver.delete_many([os.path.join(pool, p) for p in batch])
+        for p in batch:
+            subvolume_index.removed(pool, p)
+        if job is not None:
+            job.progress(len(batch))
+
+
+def _destroy_batches(req, uuid):
+    """
+    (pool, batches of paths) to delete to destroy file system uuid: its
+    snapshots first, then their directory and the file system
+    """
     # Check to see if this file system has any read-only snapshots, if yes then
     # delete.  The API requires a FS to list its RO copies, we may want to
     # reconsider this decision.
 
     fs_ht = _get_fs_by_uuid(req, uuid)
+    if not fs_ht:
+        raise TargetdError(TargetdError.NOT_FOUND_FS, "fs_uuid not found")
+
+    pool = fs_ht['pool']
+    base_snapshot_dir = os.path.join(ss_path, fs_ht['name'])
+
+    snapshots = [os.path.join(base_snapshot_dir, s['name'])
+                 for s in ss(req, uuid, fs_ht)]
+
+    last = []
+    if os.path.exists(os.path.join(pool, base_snapshot_dir)):
+        last.append(base_snapshot_dir)
+    last.append(os.path.join(fs_path, fs_ht['name']))
 
-    base_snapshot_dir = os.path.join(fs_ht['pool'], ss_path, fs_ht['name'])
+    return pool, [b for b in (snapshots, last) if b]
 
-    snapshots = ss(req, uuid)
-    for s in snapshots:
-        fs_subvolume_delete(os.path.join(base_snapshot_dir, s['name']))
 
-    if os.path.exists(base_snapshot_dir):
-        fs_subvolume_delete(base_snapshot_dir)
+def _destroy(req, uuid, job=None):
+    pool, batches = _destroy_batches(req, uuid)
+    if job is not None:
+        job.total = sum(len(b) for b in batches)
+    for batch in batches:
+        _delete_many(pool, batch, job)
 
-    fs_subvolume_delete(os.path.join(fs_ht['pool'], fs_path, fs_ht['name']))
+
+def fs_destroy(req, uuid, background=False):
+    if background:
+        pool, batches = _destroy_batches(req, uuid)
+        return _in_background('fs_destroy',
+                              functools.partial(_destroy, req, uuid),
+                              sum(len(b) for b in batches),
+                              writes=[_pool_lock(pool)])
+
+    _destroy(req, uuid)
 
 
 def fs_pools(req):
@@ -191,58 +589,104 @@ def fs_pools(req):
     return results
 
 
-def _invoke_retries(command, throw_exception):
-    # TODO take out this loop, used to handle bug in btrfs
-    # ERROR: Failed to lookup path for root 0 - No such file or directory
+def _pool_usage(pool):
+    """
+    {subvolume id: usage} of the qgroups of pool, read in one go, empty
+    without fs_quota.
+    """
+    if not quota:
+        return {}
+    return driver.qgroup_usage(pool)
+
+
+def _fs_object(pool, name, entry, space, usage):
+    total, free = space
+    key = os.path.join(pool, fs_path, name)
+    rc = dict(
+        name=name,
+        uuid=entry['uuid'],
+        total_space=total,
+        free_space=free,
+        pool=pool,
+        full_path=key)
+
+    u = usage.get(entry.get('id'))
+    if u is not None:
+        rc['used_space'] = u['referenced']
+        rc['exclusive_space'] = u['exclusive']
+        if u['limit'] is not None:
+            rc['total_space'] = u['limit']
+            rc['free_space'] = max(0, min(free, u['limit'] - u['referenced']))
+    return rc
+
 
-    for i in range(0, 5):
-        result, out, err = invoke(command, False)
-        if result == 0:
-            return result, out, err
-        elif result == 19:
-            time.sleep(1)
-            continue
-        else:
-            raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
-                               "Unexpected exit code %d" % result)
+def _ss_object(name, entry):
+    return dict(name=name, uuid=entry['uuid'], timestamp=entry['otime'])
 
-    raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
-                       "Unable to execute command after "
-                       "multiple retries %s" % (str(command)))
 
+def _snapshots_by_fs(subvolumes):
+    """
+    {fs name: [snapshot objects]} of the snapshots in a pool, grouped by
+    their targetd_ss/<fs name> directory like ss() finds them.  Replicas
+    received from another pool have no parent there, so parent uuids can't
+    be used.
+    """
+    rc = {}
+    for path, entry in subvolumes.by_path.items():
+        if entry['otime'] is None or \
+                not path.startswith(ss_path + os.path.sep):
+            continue
+        fs_dir, name = os.path.split(path[len(ss_path) + 1:])
+        if not fs_dir or os.path.sep in fs_dir:
+            continue
+        rc.setdefault(fs_dir, []).append(_ss_object(name, entry))
+    for snapshots in rc.values():
+        snapshots.sort(key=lambda s: (s['timestamp'], s['name']))
+    return rc
 
-def _fs_hash():
-    fs_list = {}
 
-    for pool in pools:
-        full_path = os.path.join(pool, fs_path)
+def _pool_listing(pool):
+    return subvolume_index.pool(pool), _pool_usage(pool)
 
-        result, out, err = _invoke_retries(
-            [fs_cmd, 'subvolume', 'list', '-ua', pool], False)
 
-        data = split_stdout(out)
-        if len(data):
-            (total, free) = fs_space_values(full_path)
-            for e in data:
-                sub_vol = e[10]
+def _pool_listings(pool_names):
+    """
+    [(pool, _PoolSubvolumes, usage)] of pool_names.  Pools are listed in
+    parallel when there are several, each one is a separate file system.
+    """
+    if len(pool_names) > 1:
+        with ThreadPoolExecutor(max_workers=len(pool_names)) as executor:
+            listings = list(executor.map(_pool_listing, pool_names))
+    else:
+        listings = [_pool_listing(pool) for pool in pool_names]
+    return [(pool,) + listing for pool, listing in zip(pool_names, listings)]
 
-                prefix = fs_path + os.path.sep
 
-                if sub_vol[:len(prefix)] == prefix:
-                    key = os.path.join(pool, sub_vol)
-                    fs_list[key] = dict(
-                        name=sub_vol[len(prefix):],
-                        uuid=e[8],
-                        total_space=total,
-                        free_space=free,
-                        pool=pool,
-                        full_path=key)
+def _fs_entries(pool_names, include_snapshots=False):
+    for pool, subvolumes, usage in _pool_listings(pool_names):
+        space = None
+        snapshots = None
+        for name, entry in subvolumes.children(fs_path):
+            if space is None:
+                space = fs_space_values(os.path.join(pool, fs_path))
+                if include_snapshots:
+                    snapshots = _snapshots_by_fs(subvolumes)
+            rc = _fs_object(pool, name, entry, space, usage)
+            if include_snapshots:
+                rc['snapshots'] = snapshots.get(name, [])
+            yield rc
 
-    return fs_list
 
+def fs(req, pool=None, offset=None, limit=None, after=None, name=None,
+       name_prefix=None, uuid=None, include_snapshots=False):
+    pool_names = pools
+    if pool is not None:
+        pool_check(pool)
+        pool_names = [pool]
 
-def fs(req):
-    return list(_fs_hash().values())
+    return select(_fs_entries(pool_names, include_snapshots), ('pool', 'name'),
+                  offset, limit, after, prefixes=dict(name=name_prefix),
+                  name=name, uuid=uuid)
 
 
 def ss(req, fs_uuid, fs_cache=None):
@@ -250,29 +694,61 @@ def ss(req, fs_uuid, fs_cache=None):
 
     if fs_cache is None:
         fs_cache = _get_fs_by_uuid(req, fs_uuid)
+        if not fs_cache:
+            raise TargetdError(TargetdError.NOT_FOUND_FS, "fs_uuid not found")
 
-    full_path = os.path.join(fs_cache['pool'], ss_path, fs_cache['name'])
+    subvolumes = subvolume_index.pool(fs_cache['pool'])
+    for name, entry in subvolumes.children(
+            os.path.join(ss_path, fs_cache['name'])):
+        if entry['otime'] is not None:
+            snapshots.append(_ss_object(name, entry))
 
-    if os.path.exists(full_path):
-        result, out, err = _invoke_retries(
-            [fs_cmd, 'subvolume', 'list', '-s', full_path], False)
+    return snapshots
 
-        data = split_stdout(out)
-        if len(data):
-            for e in data:
-                ts = "%s %s" % (e[10], e[11])
-                time_epoch = int(
-                    time.mktime(time.strptime(ts, '%Y-%m-%d %H:%M:%S')))
-                st = dict(name=e[-1], uuid=e[-3], timestamp=time_epoch)
-                snapshots.append(st)
 
-    return snapshots
+def fs_get(req, pool_name=None, name=None, uuid=None):
+    """
+    Return the file system named name in pool_name or the one with the given
+    uuid, like an entry of fs_list, without listing the pools.
+    """
+    if (name is None) == (uuid is None) or \
+            name is not None and pool_name is None:
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "Either pool_name and name or uuid is required")
+
+    pool_names = pools
+    if pool_name is not None:
+        pool_check(pool_name)
+        pool_names = [pool_name]
+
+    for pool in pool_names:
+        subvolumes = subvolume_index.pool(pool)
+        if name is not None:
+            entry = subvolumes.by_path.get(os.path.join(fs_path, name))
+        else:
+            entry = subvolumes.by_uuid.get(uuid)
+
+        if entry is None:
+            continue
+        fs_name = entry['path'][len(fs_path) + 1:]
+        if not entry['path'].startswith(fs_path + os.path.sep) or \
+                os.path.sep in fs_name:
+            # not a file system but a snapshot or one of our directories
+            continue
+
+        return _fs_object(pool, fs_name, entry, fs_space_values(
+            os.path.join(pool, fs_path)), _pool_usage(pool))
+
+    raise TargetdError(TargetdError.NOT_FOUND_FS, "fs not found")
 
 
 def _get_fs_by_uuid(req, fs_uuid):
-    for f in fs(req):
-        if f['uuid'] == fs_uuid:
-            return f
+    try:
+        return fs_get(req, uuid=fs_uuid)
+    except TargetdError as e:
+        if e.error != TargetdError.NOT_FOUND_FS:
+            raise
+    return None
 
 
 def _get_ss_by_uuid(req, fs_uuid, ss_uuid, fs_ht=None):
@@ -291,7 +767,7 @@ def fs_clone(req, fs_uuid, dest_fs_name, snapshot_id):
         raise TargetdError(TargetdError.NOT_FOUND_FS, "fs_uuid not found")
 
     if snapshot_id:
-        snapshot = _get_ss_by_uuid(req, fs_uuid, snapshot_id)
+        snapshot = _get_ss_by_uuid(req, fs_uuid, snapshot_id, fs_ht)
         if not snapshot:
             raise TargetdError(TargetdError.NOT_FOUND_SS, "snapshot not found")
 
@@ -306,7 +782,113 @@ def fs_clone(req, fs_uuid, dest_fs_name, snapshot_id):
         raise TargetdError(TargetdError.EXISTS_CLONE_NAME,
                            "Filesystem with that name exists")
 
-    invoke([fs_cmd, 'subvolume', 'snapshot', source, dest])
+    driver.snapshot(source, dest)
+    subvolume_index.added(fs_ht['pool'], os.path.join(fs_path, dest_fs_name))
+
+
+def _replicate(req, fs_uuid, ss_uuid, dest_pool):
+    pool_check(dest_pool)
+    fs_ht = _get_fs_by_uuid(req, fs_uuid)
+    if not fs_ht:
+        raise TargetdError(TargetdError.NOT_FOUND_FS, "fs_uuid not found")
+    if dest_pool == fs_ht['pool']:
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "dest_pool is the pool of the file system, use "
+                           "fs_clone")
+
+    snapshots = ss(req, fs_uuid, fs_ht)
+    for snapshot in snapshots:
+        if snapshot['uuid'] == ss_uuid:
+            break
+    else:
+        raise TargetdError(TargetdError.NOT_FOUND_SS, "snapshot not found")
+
+    fs_name = fs_ht['name']
+    snapshot_dir = os.path.join(ss_path, fs_name)
+    dest = subvolume_index.pool(dest_pool)
+
+    # received uuid -> name of the replicas already in dest_pool
+    replicas = dict((e['received_uuid'], name)
+                    for name, e in dest.children(snapshot_dir)
+                    if e['received_uuid'] is not None)
+    if ss_uuid in replicas or \
+            os.path.exists(os.path.join(dest_pool, snapshot_dir,
+                                        snapshot['name'])):
+        raise TargetdError(TargetdError.EXISTS_FS_NAME,
+                           "Snapshot already exists in dest_pool")
+    dest_fs = dest.by_path.get(os.path.join(fs_path, fs_name))
+    if dest_fs is not None and not replicas:
+        raise TargetdError(TargetdError.EXISTS_FS_NAME,
+                           "Another file system with that name exists in "
+                           "dest_pool")
+
+    # Send the differences from the newest older snapshot already there
+    parent = None
+    for s in sorted(snapshots, key=lambda s: (s['timestamp'], s['name']),
+                    reverse=True):
+        if s['uuid'] != ss_uuid and s['uuid'] in replicas and \
+                s['timestamp'] <= snapshot['timestamp']:
+            parent = s
+            break
+
+    dest_dir = os.path.join(dest_pool, snapshot_dir)
+    relpath = os.path.join(snapshot_dir, snapshot['name'])
+    create_sub_volume(dest_dir)
+    try:
+        btrfs.send_receive(
+            os.path.join(fs_ht['pool'], relpath), dest_dir,
+            os.path.join(fs_ht['pool'], snapshot_dir, parent['name'])
+            if parent else None)
+    except TargetdError:
+        # don't leave a partly received subvolume behind
+        if os.path.exists(os.path.join(dest_pool, relpath)):
+            with ignored(TargetdError):
+                driver.delete(os.path.join(dest_pool, relpath))
+        raise
+
+    entry = driver.show(dest_pool, os.path.join(dest_pool, relpath))
+    subvolume_index.added(dest_pool, relpath, entry)
+
+    # The first replica also becomes a writable file system in dest_pool,
+    # the next ones are listed as its snapshots
+    if dest_fs is None:
+        driver.snapshot(os.path.join(dest_pool, relpath),
+                        os.path.join(dest_pool, fs_path, fs_name))
+        subvolume_index.added(dest_pool, os.path.join(fs_path, fs_name))
+        dest_fs = subvolume_index.pool(dest_pool).by_path.get(
+            os.path.join(fs_path, fs_name))
+
+    return dict(pool=dest_pool, name=snapshot['name'],
+                uuid=entry['uuid'] if entry else None,
+                fs_uuid=dest_fs['uuid'] if dest_fs else None,
+                incremental_from=parent['name'] if parent else None)
+
+
+def fs_replicate(req, fs_uuid, ss_uuid, dest_pool, background=False):
+    """
+    Copy snapshot ss_uuid of file system fs_uuid to another fs pool with
+    btrfs send/receive, incrementally when an older snapshot was replicated
+    before.  Only the source pool is locked for reading and dest_pool for
+    writing while it runs, background replications have a job lane of
+    their own.
+    """
+    if background:
+        pool_check(dest_pool)
+        fs_ht = _get_fs_by_uuid(req, fs_uuid)
+        if not fs_ht:
+            raise TargetdError(TargetdError.NOT_FOUND_FS, "fs_uuid not found")
+
+        def _job(job):
+            rc = _replicate(req, fs_uuid, ss_uuid, dest_pool)
+            job.progress()
+            return rc
+
+        return _in_background('fs_replicate', _job, 1,
+                              reads=[_pool_lock(fs_ht['pool'])],
+                              writes=[_pool_lock(dest_pool)],
+                              lane='replication')
+
+    return _replicate(req, fs_uuid, ss_uuid, dest_pool)
 
 
 def nfs_export_auth_list(req):
@@ -321,12 +903,7 @@ def nfs_export_list(req):
     return rc
 
 
-def nfs_export_add(req, host, path, export_path, options):
-
-    if export_path is not None:
-        raise TargetdError(TargetdError.NFS_NO_SUPPORT,
-                           "separate export path not supported at "
-                           "this time")
+def _export_options(options):
     bit_opt = 0
     key_opt = {}
 
@@ -337,18 +914,114 @@ def nfs_export_add(req, host, path, export_path, options):
         else:
             bit_opt |= Export.bool_option[o]
 
-    Nfs.export_add(host, path, bit_opt, key_opt)
+    return bit_opt, key_opt
 
 
-def nfs_export_remove(req, host, path):
-    found = False
+def nfs_export_add(req, host, path, export_path, options):
+
+    if export_path is not None:
+        raise TargetdError(TargetdError.NFS_NO_SUPPORT,
+                           "separate export path not supported at "
+                           "this time")
+
+    Nfs.export_add(host, path, *_export_options(options))
 
-    for e in Nfs.exports():
-        if e.host == host and e.path == path:
-            Nfs.export_remove(e)
-            found = True
 
-    if not found:
+def nfs_export_remove(req, host, path):
+    export = Nfs.export_table().get((host, path))
+
+    if export is None:
         raise TargetdError(TargetdError.NOT_FOUND_NFS_EXPORT,
                            "NFS export to remove not found %s:%s",
                            (host, path))
+    Nfs.export_remove(export)
+
+
+def _bulk_items(items, name):
+    """
+    Yields (result, host, path, item) for each {host, path, ...} of items,
+    result being what is returned for it.  The ones without host and path
+    get an error result and are skipped.
+    """
+    if not isinstance(items, list):
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "%s must be a list" % name)
+
+    for item in items:
+        if not isinstance(item, dict):
+            item = {}
+        host = item.get('host')
+        path = item.get('path')
+        rc = dict(host=host, path=path)
+        if not host or not path:
+            rc['error'] = dict(code=TargetdError.INVALID_ARGUMENT,
+                               message="host and path are required")
+        yield rc, host, path, item
+
+
+def nfs_export_add_bulk(req, exports):
+    """
+    Adds many NFS exports at once, exports is a list of {host, path,
+    options}.  They are validated first, then our exports file is written
+    once and applied with one exportfs -ra.  Returns one {host, path}
+    result per item, in order, with an error for the ones not exported.
+    """
+    results = []
+    todo = []
+    for rc, host, path, item in _bulk_items(exports, 'exports'):
+        results.append(rc)
+        if 'error' in rc:
+            continue
+        try:
+            export = Export(host, path,
+                            *_export_options(item.get('options') or []))
+        except KeyError as e:
+            rc['error'] = dict(code=TargetdError.INVALID_ARGUMENT,
+                               message="Invalid option %s" % e)
+            continue
+        except (TypeError, ValueError) as e:
+            rc['error'] = dict(code=TargetdError.INVALID_ARGUMENT,
+                               message="Invalid options: %s" % e)
+            continue
+        todo.append((rc, export))
+
+    if todo:
+        errors = Nfs.export_add_bulk([export for rc, export in todo])
+        for rc, export in todo:
+            message = errors.get((export.host, export.path))
+            if message is not None:
+                rc['error'] = dict(code=TargetdError.UNEXPECTED_EXIT_CODE,
+                                   message=message)
+    return results
+
+
+def nfs_export_remove_bulk(req, exports):
+    """
+    Removes many NFS exports at once, exports is a list of {host, path}.
+    Like nfs_export_add_bulk the file is written once and applied with one
+    exportfs -ra.  Returns one {host, path} result per item, in order, with
+    an error for the ones not found or still exported.
+    """
+    exported = Nfs.export_table()
+
+    results = []
+    todo = []
+    for rc, host, path, item in _bulk_items(exports, 'exports'):
+        results.append(rc)
+        if 'error' in rc:
+            continue
+        if (host, path) not in exported:
+            rc['error'] = dict(code=TargetdError.NOT_FOUND_NFS_EXPORT,
+                               message="NFS export to remove not found "
+                                       "%s:%s" % (host, path))
+            continue
+        todo.append((rc, (host, path)))
+
+    if todo:
+        errors = Nfs.export_remove_bulk([key for rc, key in todo])
+        for rc, key in todo:
+            message = errors.get(key)
+            if message is not None:
+                rc['error'] = dict(code=TargetdError.UNEXPECTED_EXIT_CODE,
+                                   message=message)
+    return results
@@ -0,0 +1,161 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Background jobs: long running work (deleting subvolume trees, ...) that an
+# RPC hands over to a worker thread, returning a job id right away.  Clients
+# follow the job with the job_status RPC.
+
+import collections
+import threading
+import time
+import traceback
+import logging as log
+
+from targetd.utils import TargetdError
+
+# Seconds a finished job can still be queried
+KEEP_FINISHED = 3600
+
+
+class Job(object):
+
+    def __init__(self, job_id, method, func, total):
+        # func(job) does the work, what it returns is the job result
+        self.id = job_id
+        self.method = method
+        self.func = func
+        self.state = 'queued'
+        self.done = 0
+        self.total = total
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+
+    def progress(self, count=1):
+        """
+        Called by the job function as it goes, count items more are done
+        """
+        self.done += count
+
+    def status(self):
+        return dict(job_id=self.id, method=self.method, state=self.state,
+                    done=self.done, total=self.total, error=self.error,
+                    result=self.result, created=self.created,
+                    finished=self.finished)
+
+
+class JobQueue(object):
+    """
+    Jobs of a lane run one at a time, in the order they were submitted, by
+    a worker thread of the lane started with its first job.  Jobs that can
+    take hours (replication) get a lane of their own so that they don't
+    hold up the others.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        # lane -> deque of its queued jobs
+        self._queues = {}
+        self._jobs = {}
+        self._next_id = 1
+        self._workers = {}
+        self._stopping = False
+
+    def submit(self, method, func, total=None, lane='default'):
+        """
+        Queue func(job) to run in the background, returns the job id.
+        total is the number of items it will process, if known.
+        """
+        with self._cond:
+            if self._stopping:
+                raise TargetdError(TargetdError.INVALID,
+                                   "Shutting down, no new jobs")
+            self._prune()
+            job = Job(self._next_id, method, func, total)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._queues.setdefault(lane, collections.deque()).append(job)
+            if lane not in self._workers:
+                worker = threading.Thread(target=self._run, args=(lane,),
+                                          name="targetd-jobs-%s" % lane)
+                worker.daemon = True
+                worker.start()
+                self._workers[lane] = worker
+            self._cond.notify_all()
+            return job.id
+
+    def status(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise TargetdError(TargetdError.NOT_FOUND_JOB,
+                                   "job %s not found" % job_id)
+            return job.status()
+
+    def _prune(self):
+        cutoff = time.time() - KEEP_FINISHED
+        for job_id in [j.id for j in self._jobs.values()
+                       if j.finished is not None and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def _run(self, lane):
+        queue = self._queues[lane]
+        while True:
+            with self._cond:
+                while not queue and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                job = queue.popleft()
+                job.state = 'running'
+
+            try:
+                job.result = job.func(job)
+                state = 'done'
+            except TargetdError as e:
+                job.error = dict(code=e.error, message=str(e))
+                state = 'failed'
+            except Exception as e:
+                log.error("Job %d (%s) failed: %s" % (job.id, job.method, e))
+                log.debug(traceback.format_exc())
+                job.error = dict(code=-1,
+                                 message="%s: %s" % (type(e).__name__, e))
+                state = 'failed'
+
+            with self._cond:
+                job.state = state
+                job.finished = time.time()
+
+    def stop(self):
+        """
+        Finish the running jobs and drop the queued ones
+        """
+        with self._cond:
+            self._stopping = True
+            workers = list(self._workers.values())
+            for queue in self._queues.values():
+                for job in queue:
+                    log.warning("Job %d (%s) not run, shutting down" %
+                                (job.id, job.method))
+                queue.clear()
+            self._cond.notify_all()
+        for worker in workers:
+            worker.join()
+
+
+queue = JobQueue()
+
+
+def job_status(req, job_id):
+    return queue.status(job_id)
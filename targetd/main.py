@@ -22,16 +22,26 @@ import setproctitle
 import json
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 except ImportError:
     from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
 import yaml
 import itertools
 import socket
 import base64
 import ssl
 import traceback
+import signal
+import time
 import logging as log
-from targetd.utils import TargetdError
+from contextlib import ExitStack, closing
+try:
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
+from targetd.utils import TargetdError, locked
+from targetd import metrics
 import stat
 
 default_config_path = "/etc/target/targetd.yaml"
@@ -47,7 +57,19 @@ default_config = dict(
     ssl=False,
     ssl_cert="/etc/target/targetd_cert.pem",
     ssl_key="/etc/target/targetd_key.pem",
-    portal_addresses=["0.0.0.0"]
+    portal_addresses=["0.0.0.0"],
+    threaded=True,
+    asyncio=False,
+    max_workers=16,
+    keepalive_timeout=60,
+    lio_save_delay=1,
+    lio_index_rescan=60,
+    lvm_cache_ttl=10,
+    fs_driver='auto',
+    fs_quota=False,
+    fs_retention={},
+    fs_retry_attempts=5,
+    fs_retry_max_delay=0.5,
 )
 
 config = {}
@@ -55,30 +77,319 @@ config = {}
 # Will be added to by fs/block.initialize()
 mapping = dict()
 
+# Context managers entered around the calls of a batch request, so a module
+# can coalesce work (like saving the LIO config) across the whole batch
+batch_contexts = []
 
-class TargetHandler(BaseHTTPRequestHandler):
-    def log_request(self, code='-', size='-'):
-        # override base class - don't log good requests
-        pass
+# Called on shutdown so modules can persist state they have pending
+shutdown_hooks = []
 
-    def do_POST(self):
+# Responses are encoded and sent in chunks of about this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def check_auth(auth_header):
+    """
+    Check a HTTP basic Authorization header against the configured user and
+    password.  Returns None when they match, else the HTTP error code to send.
+    """
+    # get basic auth string, strip "Basic "
+    try:
+        auth_bytes = auth_header[6:].encode('utf-8')
+        auth_str = base64.b64decode(auth_bytes).decode('utf-8')
+        in_user, in_pass = auth_str.split(":")
+    except Exception as e:
+        log.error(traceback.format_exc())
+        return 400
+
+    if in_user != config['user'] or in_pass != config['password']:
+        return 401
+
+    return None
+
+
+class _Stream(object):
+    """
+    Result of a method produced by an iterator (generator), encoded as it is
+    sent instead of as a whole.  It is started right away so that errors
+    raised before the first item still produce an error response.
+    """
+
+    def __init__(self, it, done):
+        self._it = it
+        self._done = done
+        self._head = []
+        for item in it:
+            self._head.append(item)
+            break
+
+    def __iter__(self):
+        return itertools.chain(self._head, self._it)
+
+    def close(self, failed=False):
+        close = getattr(self._it, 'close', None)
+        if close is not None:
+            close()
+        if self._done is not None:
+            self._done(failed)
+            self._done = None
+
+
+class _StreamError(Exception):
+    """
+    Producing a streamed result failed, response is the jsonrpc error to
+    send instead if none of the result was sent yet
+    """
+
+    def __init__(self, response):
+        Exception.__init__(self, response['error']['message'])
+        self.response = response
+
+
+def _observe(method, start, error_code=None):
+    # Only label with the names of existing methods
+    if not isinstance(method, str) or method not in mapping:
+        method = "unknown"
+    metrics.observe_call(method, time.time() - start, error_code)
+
+
+def _rpc_call(req, request):
+    """
+    Run one decoded jsonrpc-2.0 request and return the response object.
+    """
+    error = (-1, "jsonrpc error")
+    id_num = 0
+    method = None
+    start = time.time()
+
+    try:
+        try:
+            version = request['jsonrpc']
+            if version != "2.0":
+                raise ValueError
+            method = request['method']
+            id_num = int(request['id'])
+            params = request.get('params', None)
+        except (KeyError, ValueError, TypeError, AttributeError):
+            error = (-32600, "not a valid jsonrpc-2.0 request")
+            raise
 
-        rpcdata = ""
-        error = None
-        id_num = 0
+        try:
+            if params:
+                result = mapping[method](req, **params)
+            else:
+                result = mapping[method](req)
+            if isinstance(result, Iterator):
+                # timed until it is sent
+                result = _Stream(result, lambda failed: _observe(
+                    method, start, -1 if failed else None))
+        except KeyError:
+            error = (-32601, "method %s not found" % method)
+            log.debug(traceback.format_exc())
+            raise
+        except TypeError:
+            error = (TargetdError.INVALID_ARGUMENT,
+                     "invalid method arguments(s)")
+            log.debug(traceback.format_exc())
+            raise
+        except TargetdError as td:
+            error = (td.error, str(td))
+            raise
+        except Exception as e:
+            error = (-1, "%s: %s" % (type(e).__name__, e))
+            log.debug(traceback.format_exc())
+            raise
+
+        if not isinstance(result, _Stream):
+            _observe(method, start)
+        return dict(result=result, id=id_num, jsonrpc="2.0")
+    except:
+        log.debug(traceback.format_exc())
+        log.debug('Error=%s, msg=%s' % (error[0], error[1]))
+        _observe(method, start, error[0])
+        return dict(
+            error=dict(code=error[0], message=error[1]),
+            id=id_num,
+            jsonrpc="2.0")
+
+
+def _encode(response):
+    """
+    Yield the JSON text of a response object in pieces
+    """
+    result = response.get('result')
+    if not isinstance(result, _Stream):
+        yield json.dumps(response)
+        return
 
-        # get basic auth string, strip "Basic "
+    failed = True
+    try:
+        yield '{"result": ['
+        sep = ''
         try:
-            auth_bytes = self.headers.get("Authorization")[6:].encode('utf-8')
-            auth_str = base64.b64decode(auth_bytes).decode('utf-8')
-            in_user, in_pass = auth_str.split(":")
+            for item in result:
+                yield sep + json.dumps(item)
+                sep = ', '
         except Exception as e:
+            log.debug(traceback.format_exc())
+            if isinstance(e, TargetdError):
+                error = dict(code=e.error, message=str(e))
+            else:
+                error = dict(code=-1, message="%s: %s" % (type(e).__name__, e))
+            raise _StreamError(dict(error=error, id=response['id'],
+                                    jsonrpc="2.0"))
+        yield '], "id": %s, "jsonrpc": "2.0"}' % json.dumps(response['id'])
+        failed = False
+    finally:
+        result.close(failed)
+
+
+def _rpc_pieces(req, data):
+    try:
+        request = json.loads(data.decode('utf-8'))
+    except ValueError:
+        # see http://www.jsonrpc.org/specification for errcodes
+        log.debug(traceback.format_exc())
+        yield json.dumps(dict(
+            error=dict(code=-32700, message="parse error"),
+            id=0,
+            jsonrpc="2.0"))
+        return
+
+    if isinstance(request, list) and request:
+        with ExitStack() as stack:
+            for batch_context in batch_contexts:
+                stack.enter_context(batch_context())
+            yield '['
+            for i, r in enumerate(request):
+                if i:
+                    yield ', '
+                # each call is sent in full before the next one runs, its
+                # result encoded whole so that failing to produce it only
+                # turns its own response into an error
+                try:
+                    yield ''.join(_encode(_rpc_call(req, r)))
+                except _StreamError as e:
+                    yield json.dumps(e.response)
+            yield ']'
+    else:
+        for piece in _encode(_rpc_call(req, request)):
+            yield piece
+
+
+def rpc_stream(req, data):
+    """
+    Run the jsonrpc-2.0 request contained in the bytes 'data' and return the
+    encoded response as an iterator of byte chunks.  'req' is passed through
+    to the called method.
+
+    Nothing runs before the first chunk is requested.  A method returning an
+    iterator (like the *_list calls) has its result encoded while it is
+    produced, the resource locks of the call stay held until it is sent, so
+    the iterator must be exhausted or closed.  An error while producing it is
+    answered with a jsonrpc error when no chunk was returned yet.  After that
+    it can't be reported anymore: it is logged and the exception raised to
+    the caller, which should drop the connection.
+
+    A batch (array of requests) is answered with an array of responses, the
+    calls run in order inside every context of batch_contexts.
+    """
+    with closing(_rpc_pieces(req, data)) as pieces:
+        chunk = []
+        size = 0
+        sent = False
+        try:
+            for piece in pieces:
+                chunk.append(piece)
+                size += len(piece)
+                if size >= STREAM_CHUNK_SIZE:
+                    sent = True
+                    yield ''.join(chunk).encode('utf-8')
+                    chunk = []
+                    size = 0
+        except _StreamError as e:
+            if sent:
+                log.error("Error while sending a response, dropping it: %s"
+                          % e)
+                raise
+            chunk = [json.dumps(e.response)]
+        except Exception:
+            log.error("Error while sending a response, dropping it")
             log.error(traceback.format_exc())
-            self.send_error(400)
+            raise
+        if chunk:
+            yield ''.join(chunk).encode('utf-8')
+
+
+def rpc_response(req, data):
+    """
+    Like rpc_stream(), but returns the whole encoded response
+    """
+    return b''.join(rpc_stream(req, data))
+
+
+def ssl_context():
+    """
+    Server side TLS context, loaded from the configured key and certificate
+    once and shared by all connections.
+    """
+    global _ssl_context
+
+    if _ssl_context is None:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(config["ssl_cert"], config["ssl_key"])
+        ctx.set_ciphers("HIGH:-aNULL:-eNULL:-PSK")
+        _ssl_context = ctx
+    return _ssl_context
+
+
+_ssl_context = None
+
+
+class TargetHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests, every response carries a
+    # Content-Length.  main() sets 'timeout' to close idle connections.
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, code='-', size='-'):
+        # override base class - don't log good requests
+        pass
+
+    def log_error(self, format, *args):
+        # idle keep-alive connections timing out are expected
+        if format.startswith("Request timed out"):
+            return
+        BaseHTTPRequestHandler.log_error(self, format, *args)
+
+    def do_GET(self):
+        """
+        Serve /metrics, request and backend timings in the Prometheus text
+        format
+        """
+        code = check_auth(self.headers.get("Authorization"))
+        if code:
+            self.send_error(code)
+            return
+
+        if not self.path == "/metrics":
+            self.send_error(404)
             return
 
-        if in_user != config['user'] or in_pass != config['password']:
-            self.send_error(401)
+        body = metrics.registry.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header("Content-type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        if not isinstance(self.server, ThreadingMixIn):
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+
+        code = check_auth(self.headers.get("Authorization"))
+        if code:
+            self.send_error(code)
             return
 
         if not self.path == "/targetrpc":
@@ -86,86 +397,83 @@ class TargetHandler(BaseHTTPRequestHandler):
             return
 
         try:
-            error = (-1, "jsonrpc error")
+            content_len = int(self.headers.get('content-length'))
+            data = self.rfile.read(content_len)
+        except (TypeError, ValueError):
+            # Reported back as a jsonrpc parse error
+            data = b''
+
+        with closing(rpc_stream(self, data)) as stream:
             try:
-                content_len = int(self.headers.get('content-length'))
-                req = json.loads(self.rfile.read(content_len).decode('utf-8'))
-            except ValueError:
-                # see http://www.jsonrpc.org/specification for errcodes
-                error = (-32700, "parse error")
-                raise
+                first = next(stream, b'')
+                second = next(stream, None)
+            except Exception:
+                self.send_error(500)
+                return
 
             self.send_response(200)
             self.send_header("Content-type", "application/json")
+            if second is None:
+                # fits in one chunk
+                self.send_header("Content-Length", str(len(first)))
+            elif self.request_version == "HTTP/1.1":
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                # HTTP/1.0 client, closing the connection ends the data
+                self.close_connection = True
+            if not isinstance(self.server, ThreadingMixIn):
+                # Don't let one idle client hold up a serial server
+                self.close_connection = True
+            if self.close_connection:
+                self.send_header("Connection", "close")
             self.end_headers()
 
-            try:
-                version = req['jsonrpc']
-                if version != "2.0":
-                    raise ValueError
-                method = req['method']
-                id_num = int(req['id'])
-                params = req.get('params', None)
-            except (KeyError, ValueError):
-                error = (-32600, "not a valid jsonrpc-2.0 request")
-                raise
+            if second is None:
+                self.wfile.write(first)
+                return
 
+            chunked = self.request_version == "HTTP/1.1"
             try:
-                if params:
-                    result = mapping[method](self, **params)
-                else:
-                    result = mapping[method](self)
-            except KeyError:
-                error = (-32601, "method %s not found" % method)
-                log.debug(traceback.format_exc())
-                raise
-            except TypeError:
-                error = (TargetdError.INVALID_ARGUMENT,
-                         "invalid method arguments(s)")
-                log.debug(traceback.format_exc())
-                raise
-            except TargetdError as td:
-                error = (td.error, str(td))
-                raise
-            except Exception as e:
-                error = (-1, "%s: %s" % (type(e).__name__, e))
-                log.debug(traceback.format_exc())
-                raise
-
-            rpcdata = json.dumps(dict(result=result, id=id_num, jsonrpc="2.0"))
-        except:
-            log.debug(traceback.format_exc())
-            log.debug('Error=%s, msg=%s' % (error[0], error[1]))
-            rpcdata = json.dumps(
-                dict(
-                    error=dict(code=error[0], message=error[1]),
-                    id=id_num,
-                    jsonrpc="2.0"))
-        finally:
-            self.wfile.write(rpcdata.encode('utf-8'))
+                for chunk in itertools.chain([first, second], stream):
+                    if chunked:
+                        chunk = b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                    self.wfile.write(chunk)
+            except Exception:
+                # rpc_stream() logged its own errors, a client going away
+                # needs no report.  Leave the body unterminated so the client
+                # sees the response is incomplete.
+                self.close_connection = True
+                return
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
 
 
 class HTTPService(HTTPServer, object):
     """
     Handle requests one at a time
+    """
+
+
+class ThreadedHTTPService(ThreadingMixIn, HTTPService):
+    """
+    Handle each request in its own thread
 
-    Note: The liblvm library we use is not thread safe, thus we need to
-    serialize access to it.  It has locking for concurrent process usage, but
-    we will keep things simple by serializing calls to it.
+    Handlers are wrapped with resource locks (see utils.locked) when the
+    mapping is built: list calls on a pool run in parallel, while calls
+    modifying a block pool (VG), fs pool, the NFS exports or the LIO configfs
+    tree are serialized against other users of that same resource only.
     """
+    daemon_threads = True
 
 
 class TLSHTTPService(HTTPService):
     """Also use TLS to encrypt the connection"""
 
     def finish_request(self, sock, addr):
-        sockssl = ssl.wrap_socket(
-            sock,
-            server_side=True,
-            keyfile=config["ssl_key"],
-            certfile=config["ssl_cert"],
-            ciphers="HIGH:-aNULL:-eNULL:-PSK",
-            suppress_ragged_eofs=True)
+        # Don't wait forever on a client stalling the handshake
+        sock.settimeout(config['keepalive_timeout'])
+        sockssl = ssl_context().wrap_socket(
+            sock, server_side=True, suppress_ragged_eofs=True)
         return self.RequestHandlerClass(sockssl, addr, self)
 
     @staticmethod
@@ -198,6 +506,11 @@ class TLSHTTPService(HTTPService):
                 and TLSHTTPService._verify_ssl_file(config["ssl_cert"]))
 
 
+class ThreadedTLSHTTPService(ThreadingMixIn, TLSHTTPService):
+    """TLS and a thread per request, the handshake also runs in that thread"""
+    daemon_threads = True
+
+
 def load_config(config_path):
     global config
 
@@ -240,6 +553,8 @@ def update_mapping():
     # wait until now so submodules can import 'main' safely
     import targetd.block as block
     import targetd.fs as fs
+    import targetd.jobs as jobs
+    import targetd.retention as retention
 
     try:
         mapping.update(block.initialize(config))
@@ -249,6 +564,7 @@ def update_mapping():
 
     try:
         mapping.update(fs.initialize(config))
+        retention.initialize(config)
     except Exception as e:
         log.error("Error initializing fs module: %s" % e)
         raise
@@ -257,7 +573,28 @@ def update_mapping():
     def pool_list(req):
         return list(itertools.chain(block.block_pools(req), fs.fs_pools(req)))
 
-    mapping['pool_list'] = pool_list
+    mapping['pool_list'] = locked(
+        pool_list, reads=[block.pool_locks, fs.pool_locks])
+    mapping['job_status'] = jobs.job_status
+
+    batch_contexts.append(block.saves_deferred)
+    shutdown_hooks.append(block.flush_config)
+    shutdown_hooks.append(retention.scheduler.stop)
+    shutdown_hooks.append(jobs.queue.stop)
+
+
+def _sigterm(signum, frame):
+    # systemd stops us with SIGTERM, shut down as on SIGINT
+    raise KeyboardInterrupt
+
+
+def shutdown():
+    log.info("signal received, shutting down")
+    for hook in shutdown_hooks:
+        try:
+            hook()
+        except Exception as e:
+            log.error("Error during shutdown: %s" % e)
 
 
 def main():
@@ -277,25 +614,61 @@ def main():
         return -1
 
     if config['ssl']:
-        server_class = TLSHTTPService
-
         # Make sure certificates are good to go!
         if not TLSHTTPService.verify_certificates():
             return -1
 
-        note = "(TLS yes)"
+    signal.signal(signal.SIGTERM, _sigterm)
+
+    if config['asyncio']:
+        return main_async()
+
+    if config['ssl']:
+        if config['threaded']:
+            server_class = ThreadedTLSHTTPService
+        else:
+            server_class = TLSHTTPService
+        note = "(TLS yes"
+    else:
+        if config['threaded']:
+            server_class = ThreadedHTTPService
+        else:
+            server_class = HTTPService
+        note = "(TLS no"
+
+    if config['threaded']:
+        note += ", threaded)"
     else:
-        server_class = HTTPService
-        note = "(TLS no)"
+        note += ")"
+
+    TargetHandler.timeout = config['keepalive_timeout']
 
     try:
         server = server_class(('', 18700), TargetHandler)
         log.info("started server %s", note)
         server.serve_forever()
     except KeyboardInterrupt:
-        log.info("SIGINT received, shutting down")
         if server is not None:
             server.socket.close()
+        shutdown()
+        return -1
+
+    return 0
+
+
+def main_async():
+    """
+    Serve the API from the asyncio front end, config and mapping must already
+    be set up by main().
+    """
+    import targetd.aio as aio
+
+    try:
+        log.info("started asyncio server (TLS %s, %d workers)",
+                 "yes" if config['ssl'] else "no", config['max_workers'])
+        aio.serve(config)
+    except KeyboardInterrupt:
+        shutdown()
         return -1
 
     return 0
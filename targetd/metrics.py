@@ -0,0 +1,201 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Request and backend timings, served in the Prometheus text format on
+# /metrics.
+#
+# Every RPC call is timed per method, and the time spent in the backends is
+# broken out: libblockdev (LVM), rtslib (configfs) and the commands run by
+# utils.invoke() (btrfs, exportfs, ...).
+
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+
+class Registry(object):
+    """
+    Histograms and counters keyed by metric name and label values
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (help, type, label names, {label values: Histogram/int})
+        self._metrics = {}
+        # callables returning [(name, help, type, {labels: value})]
+        self._collectors = []
+
+    def _series(self, name, help_text, kind, labels):
+        if name not in self._metrics:
+            self._metrics[name] = (help_text, kind, labels, {})
+        return self._metrics[name][3]
+
+    def observe(self, name, help_text, labels, values, seconds):
+        with self._lock:
+            series = self._series(name, help_text, 'histogram', labels)
+            if values not in series:
+                series[values] = Histogram()
+            series[values].observe(seconds)
+
+    def inc(self, name, help_text, labels, values, amount=1):
+        with self._lock:
+            series = self._series(name, help_text, 'counter', labels)
+            series[values] = series.get(values, 0) + amount
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _labels(names, values, extra=()):
+        pairs = list(zip(names, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for n, v in pairs)
+
+    def render(self):
+        out = []
+
+        def _head(name, help_text, kind):
+            out.append('# HELP %s %s' % (name, help_text))
+            out.append('# TYPE %s %s' % (name, kind))
+
+        with self._lock:
+            for name in sorted(self._metrics):
+                help_text, kind, labels, series = self._metrics[name]
+                _head(name, help_text, kind)
+                for values in sorted(series):
+                    if kind == 'counter':
+                        out.append('%s%s %d' % (
+                            name, self._labels(labels, values),
+                            series[values]))
+                        continue
+
+                    h = series[values]
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, h.counts):
+                        cumulative += count
+                        out.append('%s_bucket%s %d' % (
+                            name,
+                            self._labels(labels, values, [('le', bound)]),
+                            cumulative))
+                    out.append('%s_bucket%s %d' % (
+                        name, self._labels(labels, values, [('le', '+Inf')]),
+                        h.count))
+                    out.append('%s_sum%s %f' % (
+                        name, self._labels(labels, values), h.sum))
+                    out.append('%s_count%s %d' % (
+                        name, self._labels(labels, values), h.count))
+
+        for collector in self._collectors:
+            for name, help_text, kind, series in collector():
+                _head(name, help_text, kind)
+                for labels, value in sorted(series.items()):
+                    out.append('%s%s %s' % (
+                        name, self._labels([l[0] for l in labels],
+                                           [l[1] for l in labels]), value))
+
+        return '\n'.join(out) + '\n'
+
+
+registry = Registry()
+
+
+def observe_call(method, seconds, error_code=None):
+    """
+    Record one RPC call of method, error_code is None when it succeeded
+    """
+    registry.observe('targetd_rpc_duration_seconds',
+                     'Time spent serving RPC calls', ('method',), (method,),
+                     seconds)
+    if error_code is not None:
+        registry.inc('targetd_rpc_errors_total',
+                     'RPC calls which returned an error',
+                     ('method', 'code'), (method, error_code))
+
+
+@contextmanager
+def timed(backend, operation):
+    """
+    Time the enclosed block as an operation of backend (libblockdev,
+    rtslib, invoke)
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        registry.observe('targetd_backend_duration_seconds',
+                         'Time spent in libblockdev, rtslib and commands',
+                         ('backend', 'operation'), (backend, operation),
+                         time.time() - start)
+
+
+def timed_call(backend, operation, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed(backend, operation):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class Instrumented(object):
+    """
+    Proxy timing every function called on obj, e.g. bd.lvm
+    """
+
+    def __init__(self, backend, obj):
+        self._backend = backend
+        self._obj = obj
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        return timed_call(self._backend, name, attr)
+
+
+def invoke_operation(cmd):
+    """
+    Operation label of a command line: the program and its first word
+    argument, like "btrfs subvolume" or "exportfs"
+    """
+    rc = os.path.basename(cmd[0])
+    if len(cmd) > 1 and not cmd[1].startswith('-'):
+        rc += ' ' + cmd[1]
+    return rc
@@ -15,9 +15,16 @@ import re
 import os
 import os.path
 import shlex
+import tempfile
+from collections import OrderedDict
 from targetd.utils import invoke
 
 
+def _file_key(st):
+    # Tells whether a file changed since it was last looked at
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
 class Export(object):
 
     SECURE = 0x00000001
@@ -71,6 +78,19 @@ class Export(object):
     export_regex = '([\/a-zA-Z0-9\.-_]+)[\s]+(.+)\((.+)\)'
     octal_nums_regex = r"""\\([0-7][0-7][0-7])"""
 
+    # A line of etab: path host(options), spaces in path are escaped
+    etab_regex = r'^(\S+)\s+(\S+)\((.*)\)$'
+
+    # etab spells out every option, these values are the defaults
+    etab_defaults = dict(anonuid='65534', anongid='65534')
+
+    _export_pattern = re.compile(export_regex)
+    _etab_pattern = re.compile(etab_regex)
+    _octal_nums_pattern = re.compile(octal_nums_regex)
+
+    # exports file path -> (_file_key of the file, its exports)
+    _parsed_files = {}
+
     @staticmethod
     def _join(sep, *strings_to_join):
         rc = ''
@@ -205,27 +225,76 @@ class Export(object):
 
     @staticmethod
     def parse_exports_file(f):
-        rc = []
-
+        """
+        Returns the exports of file f, only parsed again when the file changed
+        """
         with open(f, "r") as e_f:
+            key = _file_key(os.fstat(e_f.fileno()))
+            cached = Export._parsed_files.get(f)
+            if cached is not None and cached[0] == key:
+                return list(cached[1])
+
+            rc = []
             for line in e_f:
                 exp = Export.parse_export(
                     shlex.split(Export._chr_encode(line), '#'))
                 if exp:
                     rc.extend(exp)
 
-        return rc
+        Export._parsed_files[f] = (key, rc)
+        return list(rc)
 
     @staticmethod
     def parse_exportfs_output(export_text):
         rc = []
-        pattern = re.compile(Export.export_regex)
 
-        for m in re.finditer(pattern, export_text):
+        for m in Export._export_pattern.finditer(export_text):
             rc.append(
                 Export(m.group(2), m.group(1), *Export.parse_opt(m.group(3))))
         return rc
 
+    @staticmethod
+    def _etab_options(options_string):
+        # Keeps the options we know that are not defaults.  Options after a
+        # second sec= are for other security flavors, they are left out.
+        bits = 0
+        pairs = {}
+        sec = False
+
+        for o in options_string.split(','):
+            if '=' in o:
+                key, value = o.split('=', 1)
+                if key == 'sec':
+                    if sec:
+                        break
+                    sec = True
+                if key in Export.key_pair and \
+                        Export.etab_defaults.get(key) != value:
+                    pairs[key] = value
+            elif o in Export.bool_option:
+                bits |= Export.bool_option[o]
+
+        return bits, pairs
+
+    @staticmethod
+    def parse_etab(etab_text):
+        """
+        Parse the current export table exportfs keeps in etab
+        """
+        rc = []
+
+        for line in etab_text.splitlines():
+            m = Export._etab_pattern.match(line)
+            if m is None:
+                continue
+            try:
+                rc.append(
+                    Export(m.group(2), Export._chr_encode(m.group(1)),
+                           *Export._etab_options(m.group(3))))
+            except ValueError:
+                continue
+        return rc
+
     @staticmethod
     def _append(s, a):
         if len(s):
@@ -265,17 +334,121 @@ class Export(object):
     @staticmethod
     def _chr_encode(s):
         # Replace octal values
-        p = re.compile(Export.octal_nums_regex)
-
-        for m in re.finditer(p, s):
-            s = s.replace('\\' + m.group(1), chr(int(m.group(1), 8)))
-
-        return s
+        if '\\' not in s:
+            return s
+        return Export._octal_nums_pattern.sub(
+            lambda m: chr(int(m.group(1), 8)), s)
 
     def __eq__(self, other):
         return self.path == other.path and self.host == other.host
 
 
+class _ExportsTable(object):
+    """
+    The exports targetd keeps in EXPORT_FS_CONFIG_DIR/EXPORT_FILE, so they
+    are back after a reboot: (host, path) -> line of the file.
+
+    It is built once like the file used to be rebuilt on every change,
+    from what is exported (exportfs -v) and not in /etc/exports, and again
+    only when someone else changed the file.  Changes update the table and
+    replace the file atomically, it never goes missing or half written.
+    Callers hold the NFS lock.
+    """
+
+    def __init__(self):
+        self._lines = None
+        # _file_key of the file as we last wrote it
+        self._written = None
+
+    @staticmethod
+    def _path():
+        return os.path.join(Nfs.EXPORT_FS_CONFIG_DIR, Nfs.EXPORT_FILE)
+
+    def _current(self):
+        if self._lines is not None:
+            try:
+                changed = _file_key(os.stat(self._path())) != self._written
+            except OSError:
+                changed = self._written is not None
+            if not changed:
+                return self._lines
+
+        return self.reload(Nfs.exports())
+
+    @staticmethod
+    def _user_exports():
+        """
+        (host, path) of the exports in /etc/exports, left out of the file
+        """
+        return set((e.host, e.path)
+                   for e in Export.parse_exports_file(Nfs.MAIN_EXPORT_FILE))
+
+    def reload(self, exports):
+        """
+        Build the table again from exports, what is exported now
+        """
+        user_exports = self._user_exports()
+        self._lines = OrderedDict()
+        for e in exports:
+            if (e.host, e.path) not in user_exports:
+                self._lines[(e.host, e.path)] = e.export_file_format()
+        try:
+            self._written = _file_key(os.stat(self._path()))
+        except OSError:
+            self._written = None
+        return self._lines
+
+    def set(self, export):
+        self.update(added=[export])
+
+    def remove(self, host, path):
+        lines = self._current()
+        if lines.pop((host, path), None) is not None:
+            self._save()
+
+    def update(self, added=(), removed=()):
+        """
+        Set the exports of added, drop the (host, path) of removed and write
+        the file once
+        """
+        lines = self._current()
+        user_exports = self._user_exports()
+        for export in added:
+            key = (export.host, export.path)
+            if key not in user_exports:
+                lines[key] = export.export_file_format()
+        for key in removed:
+            lines.pop(key, None)
+        self._save()
+
+    def _save(self):
+        config_file = self._path()
+        # not named *.exports, exportfs ignores it until it is renamed
+        fd, tmp = tempfile.mkstemp(prefix='.' + Nfs.EXPORT_FILE + '.',
+                                   dir=Nfs.EXPORT_FS_CONFIG_DIR)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                os.fchmod(f.fileno(), 0o644)
+                f.write(''.join(self._lines.values()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, config_file)
+        except BaseException:
+            self._lines = None
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        dir_fd = os.open(Nfs.EXPORT_FS_CONFIG_DIR, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._written = _file_key(os.stat(config_file))
+
+
 class Nfs(object):
     """
     Python module for configuring NFS exports
@@ -284,6 +457,11 @@ class Nfs(object):
     EXPORT_FILE = 'targetd.exports'
     EXPORT_FS_CONFIG_DIR = '/etc/exports.d'
     MAIN_EXPORT_FILE = '/etc/exports'
+    ETAB = '/var/lib/nfs/etab'
+
+    _table = _ExportsTable()
+    # (_file_key of ETAB, its export table)
+    _etab = None
 
     def __init__(self):
         pass
@@ -293,32 +471,32 @@ class Nfs(object):
         return "sys", "krb5", "krb5i", "krb5p"
 
     @staticmethod
-    def _save_exports():
-        # Remove existing export
-        config_file = os.path.join(Nfs.EXPORT_FS_CONFIG_DIR, Nfs.EXPORT_FILE)
+    def export_table():
+        """
+        Return the exports by (host, path).  Read from etab, only parsed
+        again when it changed, or from exportfs -v without one.
+        """
         try:
-            os.remove(config_file)
-        except OSError:
+            with open(Nfs.ETAB, "r") as f:
+                key = _file_key(os.fstat(f.fileno()))
+                if Nfs._etab is None or Nfs._etab[0] != key:
+                    Nfs._etab = (key, OrderedDict(
+                        ((e.host, e.path), e)
+                        for e in Export.parse_etab(f.read())))
+                return OrderedDict(Nfs._etab[1])
+        except (IOError, OSError):
             pass
 
-        # Get exports in /etc/exports
-        user_exports = Export.parse_exports_file(Nfs.MAIN_EXPORT_FILE)
-
-        # Recreate all existing exports
-        with open(config_file, 'w') as ef:
-            for e in Nfs.exports():
-                if e not in user_exports:
-                    ef.write(e.export_file_format())
+        ec, out, error = invoke([Nfs.CMD, '-v'])
+        return OrderedDict(((e.host, e.path), e)
+                           for e in Export.parse_exportfs_output(out))
 
     @staticmethod
     def exports():
         """
         Return list of exports
         """
-        rc = []
-        ec, out, error = invoke([Nfs.CMD, '-v'])
-        rc = Export.parse_exportfs_output(out)
-        return rc
+        return list(Nfs.export_table().values())
 
     @staticmethod
     def export_add(host, path, bit_wise_options, key_value_options):
@@ -337,7 +515,7 @@ class Nfs(object):
 
         ec, out, err = invoke(cmd, False)
         if ec == 0:
-            Nfs._save_exports()
+            Nfs._table.set(export)
             return None
         elif ec == 22:
             raise ValueError("Invalid option: %s" % err)
@@ -352,4 +530,54 @@ class Nfs(object):
              '%s:%s' % (export.host, export.path)])
 
         if ec == 0:
-            Nfs._save_exports()
+            Nfs._table.remove(export.host, export.path)
+
+    @staticmethod
+    def _apply_bulk(added, removed):
+        # Exports made with exportfs only are not in any file, exportfs -r
+        # would drop them: start from what is exported now
+        ours = Nfs._table.reload(Nfs.exports())
+        # Exports of /etc/exports can only be unexported with exportfs -u,
+        # after exportfs -r which exports them again
+        unexport = [key for key in removed if key not in ours]
+        Nfs._table.update(added, removed)
+
+        ec, out, err = invoke([Nfs.CMD, '-ra'], False)
+        message = err.strip() or 'exportfs -ra exit code %d' % ec
+        errors = {}
+        for host, path in unexport:
+            ec, out, err = invoke([Nfs.CMD, '-u', '%s:%s' % (host, path)],
+                                  False)
+            if ec != 0:
+                errors[(host, path)] = err.strip() or \
+                    'exportfs -u exit code %d' % ec
+
+        exported = Nfs.export_table()
+        failed = [(e.host, e.path) for e in added
+                  if (e.host, e.path) not in exported]
+        for key in failed:
+            errors[key] = message
+        for key in removed:
+            if key in exported and key not in errors:
+                errors[key] = message
+        if failed:
+            # Not exported, don't try again on the next boot
+            Nfs._table.update(removed=failed)
+        return errors
+
+    @staticmethod
+    def export_add_bulk(exports):
+        """
+        Adds the exports, Export objects, writing our exports file once and
+        running a single exportfs -ra.  Returns {(host, path): error message}
+        of the ones that are not exported afterwards.
+        """
+        return Nfs._apply_bulk(exports, ())
+
+    @staticmethod
+    def export_remove_bulk(keys):
+        """
+        Removes the exports of keys, (host, path) pairs, like export_add_bulk.
+        Returns {(host, path): error message} of the ones still exported.
+        """
+        return Nfs._apply_bulk((), keys)
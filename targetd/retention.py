@@ -0,0 +1,224 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Snapshot retention for the fs pools, configured per pool with fs_retention
+# in targetd.yaml:
+#
+# fs_retention:
+#   /mnt/btrfs:
+#     interval: 3600
+#     snapshot_prefix: auto-
+#     keep_last: 3
+#     keep_daily: 7
+#
+# Every interval seconds a background job goes over the snapshots of each
+# file system of the pool (from the subvolume index) and deletes the ones no
+# rule keeps, in batches.  keep_last keeps the newest snapshots, keep_hourly
+# ... keep_yearly the newest snapshot of each of that many most recent hours
+# ... years (UTC) having snapshots.  Only snapshots named with
+# snapshot_prefix are considered.
+
+import functools
+import os
+import threading
+import time
+import logging as log
+
+from targetd import fs, jobs
+from targetd.utils import TargetdError, resource_locks
+
+# Rule name -> strftime format of the time bucket, keep_last has none
+RULES = (('keep_last', None),
+         ('keep_hourly', '%Y-%m-%d %H'),
+         ('keep_daily', '%Y-%m-%d'),
+         ('keep_weekly', '%G-%V'),
+         ('keep_monthly', '%Y-%m'),
+         ('keep_yearly', '%Y'))
+
+DEFAULT_POLICY = dict(interval=3600, snapshot_prefix='')
+
+
+def _policy(pool, settings):
+    if not isinstance(settings, dict):
+        raise TargetdError(TargetdError.INVALID,
+                           "fs_retention of %s must be a mapping" % pool)
+
+    rc = dict(DEFAULT_POLICY)
+    rule_names = [name for name, fmt in RULES]
+    for key, value in settings.items():
+        if key == 'snapshot_prefix':
+            rc[key] = str(value or '')
+            continue
+        if key != 'interval' and key not in rule_names:
+            raise TargetdError(TargetdError.INVALID,
+                               "Unknown fs_retention setting %s" % key)
+        minimum = 1 if key == 'interval' else 0
+        if isinstance(value, bool) or not isinstance(value, int) or \
+                value < minimum:
+            raise TargetdError(TargetdError.INVALID,
+                               "fs_retention %s of %s must be an integer "
+                               ">= %d" % (key, pool, minimum))
+        rc[key] = value
+
+    if not any(rc.get(name) for name in rule_names):
+        raise TargetdError(TargetdError.INVALID,
+                           "fs_retention of %s keeps no snapshot, set one of "
+                           "%s" % (pool, ', '.join(rule_names)))
+    return rc
+
+
+def check_policies(retention, pools):
+    """
+    Returns {pool: policy} of the fs_retention setting, raises TargetdError
+    on a bad one
+    """
+    if not retention:
+        return {}
+    if not isinstance(retention, dict):
+        raise TargetdError(TargetdError.INVALID,
+                           "fs_retention must map fs pools to policies")
+
+    rc = {}
+    for pool, settings in retention.items():
+        if pool not in pools:
+            raise TargetdError(TargetdError.INVALID,
+                               "fs_retention for %s, not an fs pool" % pool)
+        rc[pool] = _policy(pool, settings)
+    return rc
+
+
+def to_prune(snapshots, policy):
+    """
+    Returns the snapshots (dicts with name and timestamp, like ss_list
+    entries) that no rule of policy keeps, newest first
+    """
+    newest_first = sorted(snapshots, key=lambda s: (s['timestamp'], s['name']),
+                          reverse=True)
+    keep = set()
+
+    for rule, fmt in RULES:
+        count = policy.get(rule, 0)
+        if not count:
+            continue
+        if fmt is None:
+            keep.update(s['name'] for s in newest_first[:count])
+            continue
+
+        # newest snapshot of each of the count most recent buckets
+        buckets = set()
+        for s in newest_first:
+            bucket = time.strftime(fmt, time.gmtime(s['timestamp']))
+            if bucket in buckets:
+                continue
+            if len(buckets) == count:
+                break
+            buckets.add(bucket)
+            keep.add(s['name'])
+
+    return [s for s in newest_first if s['name'] not in keep]
+
+
+def prune_pool(pool, policy, job=None):
+    """
+    Apply policy to the snapshots of every file system of pool, returns the
+    number of snapshots deleted
+    """
+    with resource_locks.hold(writes=[fs._pool_lock(pool)]):
+        subvolumes = fs.subvolume_index.pool(pool)
+
+        paths = []
+        for fs_name, entry in sorted(subvolumes.children(fs.fs_path)):
+            snapshot_dir = os.path.join(fs.ss_path, fs_name)
+            snapshots = [
+                fs._ss_object(name, e)
+                for name, e in subvolumes.children(snapshot_dir)
+                if e['otime'] is not None and
+                name.startswith(policy['snapshot_prefix'])]
+            for s in to_prune(snapshots, policy):
+                paths.append(os.path.join(snapshot_dir, s['name']))
+
+        if job is not None:
+            job.total = len(paths)
+        if paths:
+            log.info("Retention of %s deleting %d snapshots" %
+                     (pool, len(paths)))
+            fs._delete_many(pool, paths, job)
+        return len(paths)
+
+
+class Scheduler(object):
+    """
+    Queues a retention job for each pool with a policy every interval
+    seconds, starting right away.  A pool whose previous job is still
+    queued or running is skipped until the next interval.
+    """
+
+    def __init__(self):
+        self.policies = {}
+        self._stop = threading.Event()
+        self._thread = None
+        # pool -> id of its last retention job
+        self._job_ids = {}
+
+    def start(self, policies):
+        self.policies = policies
+        if not policies:
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name="targetd-retention")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _pending(self, pool):
+        job_id = self._job_ids.get(pool)
+        if job_id is None:
+            return False
+        try:
+            state = jobs.queue.status(job_id)['state']
+        except TargetdError:
+            # finished long ago
+            return False
+        return state in ('queued', 'running')
+
+    def _run(self):
+        due = dict((pool, time.time()) for pool in self.policies)
+        while True:
+            pool = min(due, key=due.get)
+            if self._stop.wait(max(0, due[pool] - time.time())):
+                return
+            policy = self.policies[pool]
+            if self._pending(pool):
+                log.info("Retention of %s still pending, not queued again" %
+                         pool)
+            else:
+                try:
+                    self._job_ids[pool] = jobs.queue.submit(
+                        'fs_retention',
+                        functools.partial(prune_pool, pool, policy))
+                except TargetdError:
+                    # shutting down
+                    return
+            due[pool] = time.time() + policy['interval']
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+scheduler = Scheduler()
+
+
+def initialize(config_dict):
+    scheduler.start(check_policies(config_dict['fs_retention'],
+                                   config_dict['fs_pools']))
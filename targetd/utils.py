@@ -16,8 +16,18 @@
 # Utility functions.
 
 from subprocess import Popen, PIPE
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
+import asyncio
+import concurrent.futures
+import functools
+import os
+import random
+import time
+import types
+
+from targetd import metrics
 import re
+import threading
 
 
 @contextmanager
@@ -41,12 +51,14 @@ class TargetdError(Exception):
     # Common
     INVALID = -1
     NAME_CONFLICT = -50
+    NOT_FOUND_JOB = -102
     NO_SUPPORT = -153
     UNEXPECTED_EXIT_CODE = -303
     INVALID_ARGUMENT = -32602
 
     # Specific to block
     EXISTS_INITIATOR = -52
+    NOT_FOUND_VOLUME = -103
     NOT_FOUND_VOLUME_GROUP = -152
     NOT_FOUND_ACCESS_GROUP = -200
     VOLUME_MASKED = -303
@@ -67,20 +79,358 @@ class TargetdError(Exception):
         self.error = error_code
 
 
-def invoke(cmd, raise_exception=True):
+# Event loop of the asyncio front end, see set_event_loop()
+_event_loop = None
+_event_loop_thread = None
+_event_loop_lock = threading.Lock()
+# Futures of the run_in_loop() calls waiting for the loop
+_loop_calls = set()
+
+
+def set_event_loop(loop):
+    """
+    Have invoke() spawn and wait for commands on the given asyncio event loop
+    when called from any other thread, so worker threads don't each block in
+    waitpid().  Must be called from the thread running the loop, pass None to
+    go back to plain subprocess usage before the loop stops: calls still
+    waiting for it are cancelled.
+    """
+    global _event_loop
+    global _event_loop_thread
+
+    with _event_loop_lock:
+        _event_loop = loop
+        _event_loop_thread = threading.current_thread() if loop else None
+        if loop is None:
+            for future in _loop_calls:
+                future.cancel()
+
+
+def run_in_loop(coro):
+    """
+    Run coroutine coro on the event loop set with set_event_loop() from
+    another thread and return its result.  Raises
+    concurrent.futures.CancelledError when there is no loop or it goes away
+    before coro completes.
+    """
+    with _event_loop_lock:
+        if _event_loop is None:
+            coro.close()
+            raise concurrent.futures.CancelledError()
+        future = asyncio.run_coroutine_threadsafe(coro, _event_loop)
+        _loop_calls.add(future)
+    try:
+        return future.result()
+    finally:
+        with _event_loop_lock:
+            _loop_calls.discard(future)
+
+
+async def _invoke_async(cmd, env):
+    c = await asyncio.create_subprocess_exec(*cmd, stdout=PIPE, stderr=PIPE,
+                                             env=env)
+    try:
+        out = await c.communicate()
+    except asyncio.CancelledError:
+        # Shutting down, don't leave the command running unwaited
+        with ignored(ProcessLookupError):
+            c.kill()
+        raise
+    return c.returncode, out
+
+
+def invoke(cmd, raise_exception=True, env=None):
     """
     Exec a command returning a tuple (exit code, stdout, stderr) and optionally
-    throwing an exception on non-zero exit code.
+    throwing an exception on non-zero exit code.  env holds environment
+    variables to set for the command on top of ours.
     """
-    c = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    out = c.communicate()
+    if env is not None:
+        env = dict(os.environ, **env)
+
+    loop = _event_loop
+    with metrics.timed('invoke', metrics.invoke_operation(cmd)):
+        if loop is not None and threading.current_thread() is not \
+                _event_loop_thread:
+            try:
+                returncode, out = run_in_loop(_invoke_async(cmd, env))
+            except concurrent.futures.CancelledError:
+                raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
+                                   'Shutting down, "%s" not completed' %
+                                   str(cmd))
+        else:
+            c = Popen(cmd, stdout=PIPE, stderr=PIPE, env=env)
+            out = c.communicate()
+            returncode = c.returncode
 
     if raise_exception:
-        if c.returncode != 0:
+        if returncode != 0:
             cmd_str = str(cmd)
             raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE,
                                'Unexpected exit code "%s" %s, out= %s' %
-                               (cmd_str, str(c.returncode),
+                               (cmd_str, str(returncode),
                                 str(out[0] + out[1])))
 
-    return c.returncode, out[0].decode('utf-8'), out[1].decode('utf-8')
+    return returncode, out[0].decode('utf-8'), out[1].decode('utf-8')
+
+
+class Backoff(object):
+    """
+    Retry policy with exponential backoff and full jitter: retry n waits a
+    random time up to min(max_delay, base_delay * 2 ** n), so callers
+    hitting the same transient failure don't retry in lock step.
+
+    Only the calling thread sleeps, other requests are served meanwhile.
+    """
+
+    def __init__(self, attempts=5, base_delay=0.05, max_delay=0.5):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry):
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def call(self, operation, func, retryable):
+        """
+        Call func() until retryable(result) is false or the attempts are used
+        up, returns the last result.  operation labels the retry metrics.
+        """
+        for attempt in range(max(self.attempts, 1)):
+            if attempt:
+                metrics.registry.inc(
+                    'targetd_retries_total',
+                    'Operations retried after a transient failure',
+                    ('operation',), (operation,))
+                time.sleep(self.delay(attempt - 1))
+            result = func()
+            if not retryable(result):
+                return result
+
+        metrics.registry.inc(
+            'targetd_retries_exhausted_total',
+            'Operations still failing after the last retry',
+            ('operation',), (operation,))
+        return result
+
+
+class RWLock(object):
+    """
+    A lock which may be held by many readers or by a single writer.
+
+    Waiting writers block new readers so a steady stream of list calls cannot
+    starve a mutation.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class ResourceLocks(object):
+    """
+    Named reader/writer locks, one per resource (block pool, fs pool, the LIO
+    configfs tree, ...).  Locks are always taken in sorted name order so two
+    requests needing overlapping sets of resources cannot deadlock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._locks:
+                self._locks[name] = RWLock()
+            return self._locks[name]
+
+    @contextmanager
+    def hold(self, reads=(), writes=()):
+        writes = set(writes)
+        wanted = sorted(set(reads) | writes)
+        held = []
+        try:
+            for name in wanted:
+                lock = self.get(name)
+                if name in writes:
+                    lock.acquire_write()
+                    held.append(lock.release_write)
+                else:
+                    lock.acquire_read()
+                    held.append(lock.release_read)
+            yield
+        finally:
+            for release in reversed(held):
+                release()
+
+
+resource_locks = ResourceLocks()
+
+
+class _Held(object):
+    """
+    Iterator over the generator returned by a locked handler, the locks of
+    the call stay held until it is exhausted, fails or is closed.
+    """
+
+    def __init__(self, gen, stack):
+        self._gen = gen
+        self._stack = stack
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._gen)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        stack, self._stack = self._stack, None
+        if stack is not None:
+            try:
+                self._gen.close()
+            finally:
+                stack.close()
+
+    def __del__(self):
+        self.close()
+
+
+def locked(func, reads=(), writes=()):
+    """
+    Wrap an RPC handler so that it runs holding the named resource locks.
+
+    Each entry of reads/writes is either a lock name or a callable taking the
+    handler keyword arguments and returning a lock name, a list of lock names
+    or None.  Only the handlers placed in the RPC mapping are wrapped, module
+    internal calls between handlers never take the locks a second time.
+
+    A handler returning a generator keeps the locks until the caller is done
+    iterating over it (or closes it).
+    """
+
+    def _names(specs, kwargs):
+        rc = []
+        for s in specs:
+            if callable(s):
+                s = s(kwargs)
+            if s is None:
+                continue
+            if isinstance(s, (list, tuple, set, frozenset)):
+                rc.extend(s)
+            else:
+                rc.append(s)
+        return rc
+
+    @functools.wraps(func)
+    def wrapper(req, **kwargs):
+        with ExitStack() as stack:
+            stack.enter_context(resource_locks.hold(_names(reads, kwargs),
+                                                    _names(writes, kwargs)))
+            result = func(req, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                return _Held(result, stack.pop_all())
+            return result
+
+    return wrapper
+
+
+def _non_negative(name, value):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                           "%s must be a non-negative integer" % name)
+    return value
+
+
+def select(items, key, offset=None, limit=None, after=None, prefixes=None,
+           **fields):
+    """
+    Filter and page the result objects of a *_list call.
+
+    Objects are kept when every field given in fields equals the requested
+    value (None matches anything) and every field of prefixes starts with
+    the requested prefix.  When paging (offset, limit or after given) the
+    objects are sorted on the fields named in key, a unique key for the
+    listing, and 'after' is the key of the last object of the previous page:
+    unlike offset it stays correct while objects are added or removed.  A
+    key of one field may be given as the field name and its after value as a
+    scalar, longer keys as lists.
+
+    Without paging the objects are filtered lazily: the result is then a
+    generator, which the RPC layer streams to the client.
+    """
+    offset = _non_negative('offset', offset)
+    limit = _non_negative('limit', limit)
+
+    fields = dict((f, v) for f, v in fields.items() if v is not None)
+    prefixes = dict((f, p) for f, p in (prefixes or {}).items()
+                    if p is not None)
+
+    rc = (i for i in items
+          if all(i[f] == v for f, v in fields.items()) and
+          all(str(i[f]).startswith(p) for f, p in prefixes.items()))
+
+    if offset is None and limit is None and after is None:
+        return rc
+
+    if isinstance(key, str):
+        key = (key,)
+
+    def _key(i):
+        return tuple(i[f] for f in key)
+
+    rc = sorted(rc, key=_key)
+
+    if after is not None:
+        if not isinstance(after, (list, tuple)):
+            after = [after]
+        if len(after) != len(key):
+            raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                               "after must be the value of %s" %
+                               ", ".join(key))
+        after = tuple(after)
+        try:
+            rc = [i for i in rc if _key(i) > after]
+        except TypeError:
+            raise TargetdError(TargetdError.INVALID_ARGUMENT,
+                               "after must be the value of %s" %
+                               ", ".join(key))
+
+    if offset:
+        rc = rc[offset:]
+    if limit is not None:
+        rc = rc[:limit]
+    return rc
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The btrfs drivers over one file system, given both as the root tree items
+# the ioctls return and as the output of the btrfs command, and the times
+# the command prints.
+
+import calendar
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+import uuid
+from unittest import mock
+
+from targetd import btrfs
+
+# 2020-09-13 12:26:40 and 2021-03-01 00:00:05 UTC
+T1 = 1600000000
+T2 = 1614556805
+
+
+def _u():
+    return str(uuid.uuid4())
+
+
+FS_UUID = _u()
+
+# id -> (tree of the parent, directory in it, its path in there, name,
+#        uuid, parent_uuid, received_uuid, otime, root item offset)
+SUBVOLUMES = {
+    256: (5, 256, '', 'targetd_fs', _u(), None, None, None, 0),
+    257: (5, 256, '', 'targetd_ss', _u(), None, None, None, 0),
+    258: (256, 256, '', 'a b', FS_UUID, None, None, None, 0),
+    # a snapshot of 258 down in directory 'a b' of targetd_ss
+    259: (257, 300, 'a b/', 's1', _u(), FS_UUID, None, T1, 20),
+    # a fully received replica, not a snapshot to btrfs
+    261: (256, 256, '', 'replica', _u(), None, _u(), T2, 0),
+}
+# deleted, waiting to be cleaned up: a root item without a reference
+DELETED = 260
+# written by an old kernel, the root item is too short for uuids and times
+OLD = 262
+OLD_REF = (256, 256, '', 'old')
+
+
+def _root_item(subvol_uuid, parent_uuid, received_uuid, otime):
+    data = bytearray(439)
+    data[247:263] = uuid.UUID(subvol_uuid).bytes
+    if parent_uuid:
+        data[263:279] = uuid.UUID(parent_uuid).bytes
+    if received_uuid:
+        data[279:295] = uuid.UUID(received_uuid).bytes
+    struct.pack_into('<QI', data, 339, otime or 0, 0)
+    return bytes(data)
+
+
+def _backref(dirid, name):
+    return struct.pack('<QQH', dirid, 0, len(name)) + name.encode()
+
+
+def _tree_items():
+    """
+    (objectid, type, offset, data) of the root tree, in key order
+    """
+    items = []
+    for subvol_id, (tree, dirid, _, name, subvol_uuid, parent_uuid,
+                    received_uuid, otime, offset) in SUBVOLUMES.items():
+        items.append((subvol_id, btrfs.ROOT_ITEM_KEY, offset,
+                      _root_item(subvol_uuid, parent_uuid, received_uuid,
+                                 otime)))
+        items.append((subvol_id, btrfs.ROOT_BACKREF_KEY, tree,
+                      _backref(dirid, name)))
+        # other item types within the searched key range are skipped
+        items.append((subvol_id, btrfs.ROOT_ITEM_KEY + 1, 0, b'x' * 10))
+    items.append((DELETED, btrfs.ROOT_ITEM_KEY, 0,
+                  _root_item(_u(), None, None, None)))
+    items.append((OLD, btrfs.ROOT_ITEM_KEY, 0, b'\0' * 239))
+    items.append((OLD, btrfs.ROOT_BACKREF_KEY, OLD_REF[0],
+                  _backref(OLD_REF[1], OLD_REF[3])))
+    return sorted(items)
+
+
+def _path(subvol_id):
+    if subvol_id == btrfs.FS_TREE_OBJECTID:
+        return ''
+    tree, dirid, dir_path, name = (OLD_REF if subvol_id == OLD else
+                                   SUBVOLUMES[subvol_id][:4])
+    return os.path.join(_path(tree), dir_path, name)
+
+
+class FakeKernel(object):
+    """
+    Answers the tree search and inode lookup ioctls from _tree_items(), a
+    few items per call so the search has to go on where it stopped
+    """
+
+    page = 2
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.items = _tree_items()
+
+    def ioctl(self, fd, request, buf, mutate):
+        if request == btrfs.IOC_TREE_SEARCH:
+            key = list(btrfs._SEARCH_KEY.unpack_from(buf, 0))
+            low = (key[1], key[7], key[3])
+            high = (key[2], key[8], key[4])
+            found = [i for i in self.items
+                     if low <= (i[0], i[1], i[2]) <= high][:self.page]
+            pos = btrfs._SEARCH_KEY.size
+            for objectid, item_type, offset, data in found:
+                btrfs._SEARCH_HEADER.pack_into(buf, pos, 1, objectid, offset,
+                                               item_type, len(data))
+                pos += btrfs._SEARCH_HEADER.size
+                buf[pos:pos + len(data)] = data
+                pos += len(data)
+            key[9] = len(found)
+            btrfs._SEARCH_KEY.pack_into(buf, 0, *key)
+        elif request == btrfs.IOC_INO_LOOKUP:
+            tree, objectid, _ = btrfs._INO_LOOKUP.unpack_from(buf, 0)
+            if tree == 0:
+                # the subvolume fd is in
+                path = os.path.relpath(os.readlink('/proc/self/fd/%d' % fd),
+                                       self.pool)
+                tree = [i for i in list(SUBVOLUMES) + [OLD]
+                        if _path(i) == path][0]
+                name = ''
+            else:
+                name = [s[2] for s in list(SUBVOLUMES.values()) + [OLD_REF]
+                        if s[:2] == (tree, objectid)][0]
+            btrfs._INO_LOOKUP.pack_into(buf, 0, tree, objectid,
+                                        name.encode())
+        return 0
+
+
+def _cli_time(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+def _list_output():
+    """
+    'btrfs subvolume list -a -u -q -R' of the file system
+    """
+    lines = []
+    for subvol_id in sorted(list(SUBVOLUMES) + [OLD]):
+        if subvol_id == OLD:
+            tree, uuids = OLD_REF[0], (None, None, None)
+        else:
+            s = SUBVOLUMES[subvol_id]
+            tree, uuids = s[0], (s[5], s[6], s[4])
+        lines.append(
+            'ID %d gen 12 top level %d parent_uuid %s received_uuid %s '
+            'uuid %s path <FS_TREE>/%s' %
+            ((subvol_id, tree) + tuple(u or '-' for u in uuids) +
+             (_path(subvol_id),)))
+    return '\n'.join(lines) + '\n'
+
+
+def _snapshots_output():
+    """
+    'btrfs subvolume list -a -s' run in UTC, only snapshots are listed
+    """
+    return ''.join(
+        'ID %d gen 12 cgen 12 top level %d otime %s path <FS_TREE>/%s\n' %
+        (subvol_id, s[0], _cli_time(s[7]), _path(subvol_id))
+        for subvol_id, s in sorted(SUBVOLUMES.items()) if s[5] is not None)
+
+
+def _show_output(pool, subvol_id):
+    s = SUBVOLUMES[subvol_id]
+    return (
+        '%s\n'
+        '\tName: \t\t\t%s\n'
+        '\tUUID: \t\t\t%s\n'
+        '\tParent UUID: \t\t%s\n'
+        '\tReceived UUID: \t\t%s\n'
+        '\tCreation time: \t\t%s +0000\n'
+        '\tSubvolume ID: \t\t%d\n'
+        '\tGeneration: \t\t12\n' %
+        (os.path.join(pool, _path(subvol_id)), s[3], s[4], s[5] or '-',
+         s[6] or '-', _cli_time(s[7] or T2), subvol_id))
+
+
+class DriverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pool)
+        for subvol_id in list(SUBVOLUMES) + [OLD]:
+            os.makedirs(os.path.join(self.pool, _path(subvol_id)))
+
+        kernel = FakeKernel(self.pool)
+        patcher = mock.patch.object(btrfs.fcntl, 'ioctl', kernel.ioctl)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(btrfs, 'invoke', self.invoke)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def invoke(self, cmd, raise_exception=True, env=None):
+        if cmd[1:3] == ['subvolume', 'list'] and '-s' in cmd:
+            self.assertEqual(env, dict(TZ='UTC'))
+            return 0, _snapshots_output(), ''
+        if cmd[1:3] == ['subvolume', 'list']:
+            return 0, _list_output(), ''
+        if cmd[1:3] == ['subvolume', 'show']:
+            path = os.path.relpath(cmd[3], self.pool)
+            for subvol_id in SUBVOLUMES:
+                if _path(subvol_id) == path:
+                    return 0, _show_output(self.pool, subvol_id), ''
+            return 1, '', 'ERROR: not a subvolume'
+        self.fail("unexpected command %s" % cmd)
+
+    @staticmethod
+    def _by_id(entries):
+        return dict((e['id'], e) for e in entries)
+
+    def test_list(self):
+        ioctl = self._by_id(btrfs.IoctlDriver().list(self.pool))
+        cli = self._by_id(btrfs.CliDriver().list(self.pool))
+        self.assertEqual(ioctl, cli)
+
+        self.assertNotIn(DELETED, ioctl)
+        self.assertEqual(ioctl[259], dict(
+            id=259, path='targetd_ss/a b/s1', uuid=SUBVOLUMES[259][4],
+            parent_uuid=FS_UUID, received_uuid=None, otime=T1))
+        self.assertEqual(ioctl[261]['otime'], T2)
+        self.assertEqual(ioctl[258]['path'], 'targetd_fs/a b')
+        self.assertIsNone(ioctl[258]['otime'])
+        self.assertEqual(ioctl[OLD], dict(
+            id=OLD, path='targetd_fs/old', uuid=None, parent_uuid=None,
+            received_uuid=None, otime=None))
+
+    def test_show(self):
+        for subvol_id in (258, 259, 261):
+            path = os.path.join(self.pool, _path(subvol_id))
+            stat = os.stat(path)
+            with mock.patch.object(btrfs.os, 'stat') as os_stat:
+                os_stat.return_value = mock.Mock(
+                    st_ino=btrfs.FIRST_FREE_OBJECTID, st_mode=stat.st_mode)
+                ioctl = btrfs.IoctlDriver().show(self.pool, path)
+            cli = btrfs.CliDriver().show(self.pool, path)
+            self.assertEqual(ioctl, cli)
+            self.assertEqual(ioctl['path'], _path(subvol_id))
+
+    def test_show_not_subvolume(self):
+        path = os.path.join(self.pool, 'targetd_ss', 'a b')
+        self.assertIsNone(btrfs.IoctlDriver().show(self.pool, path))
+        self.assertIsNone(btrfs.CliDriver().show(self.pool, path))
+
+
+class UtcSecondsTest(unittest.TestCase):
+
+    @staticmethod
+    def _timegm(text):
+        return calendar.timegm(time.strptime(text[:19], '%Y-%m-%d %H:%M:%S'))
+
+    def test_every_day(self):
+        # 1969 to 2101: leap years, the 2000 leap century, 2100 isn't one
+        day = calendar.timegm((1969, 12, 1, 0, 0, 0)) + 12345
+        end = calendar.timegm((2101, 3, 1, 0, 0, 0))
+        while day < end:
+            text = _cli_time(day)
+            self.assertEqual(btrfs.utc_seconds(text), day, text)
+            self.assertEqual(btrfs.utc_seconds(text), self._timegm(text))
+            day += 86400 + 3661
+
+    def test_leap_days(self):
+        for text in ('2000-02-29 23:59:59', '2000-03-01 00:00:00',
+                     '2024-02-29 12:00:00', '2100-02-28 23:59:59',
+                     '2100-03-01 00:00:00', '1972-12-31 23:59:59'):
+            self.assertEqual(btrfs.utc_seconds(text), self._timegm(text),
+                             text)
+
+    def test_offsets(self):
+        # 'btrfs subvolume show' prints the offset of the local time zone,
+        # around a DST change here
+        for text, utc in (
+                ('2021-03-14 01:59:59 -0500', '2021-03-14 06:59:59'),
+                ('2021-03-14 03:00:00 -0400', '2021-03-14 07:00:00'),
+                ('2021-10-31 02:30:00 +0200', '2021-10-31 00:30:00'),
+                ('2021-10-31 02:30:00 +0100', '2021-10-31 01:30:00'),
+                ('2021-01-01 05:00:00 +0530', '2020-12-31 23:30:00'),
+                ('2024-02-29 23:00:00 -0130', '2024-03-01 00:30:00')):
+            self.assertEqual(btrfs.utc_seconds(text), self._timegm(utc),
+                             text)
+
+    def test_day_cache(self):
+        # the cache of days is cleared when full, results stay the same
+        with mock.patch.object(btrfs, '_EPOCH_DAYS_MAX', 3):
+            btrfs._epoch_days.clear()
+            for text in ('2020-01-0%d 10:00:00' % d for d in range(1, 8)):
+                self.assertEqual(btrfs.utc_seconds(text),
+                                 self._timegm(text))
+                self.assertLessEqual(len(btrfs._epoch_days), 3)
+                self.assertEqual(btrfs.utc_seconds(text),
+                                 self._timegm(text))
+
+
+if __name__ == '__main__':
+    unittest.main()
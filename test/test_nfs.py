@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Reading the export table from etab and from 'exportfs -v', and the
+# exports files.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from targetd import nfs
+from targetd.nfs import Export, Nfs
+
+ETAB = (
+    '/srv/share\t10.0.0.1(rw,sync,wdelay,hide,nocrossmnt,secure,'
+    'no_root_squash,no_all_squash,no_subtree_check,secure_locks,acl,no_pnfs,'
+    'anonuid=65534,anongid=65534,sec=sys,rw,secure,no_root_squash,'
+    'no_all_squash)\n'
+    '/srv/with\\040space\t*(ro,async,wdelay,nohide,nocrossmnt,insecure,'
+    'root_squash,all_squash,subtree_check,secure_locks,acl,no_pnfs,fsid=7,'
+    'anonuid=1000,anongid=1000,sec=sys:krb5,ro,insecure,root_squash,'
+    'all_squash)\n'
+    '/srv/multi\thost.example.com(rw,sync,wdelay,hide,nocrossmnt,secure,'
+    'root_squash,no_all_squash,no_subtree_check,secure_locks,acl,no_pnfs,'
+    'anonuid=65534,anongid=65534,sec=sys,rw,secure,root_squash,'
+    'no_all_squash,sec=krb5p,ro,secure,no_root_squash,no_all_squash)\n'
+    'garbage line\n')
+
+# What 'exportfs -v' shows of the first two, the path of a long host name
+# is on a line of its own
+EXPORTFS_V = (
+    '/srv/share    \t10.0.0.1(sync,wdelay,hide,no_subtree_check,sec=sys,rw,'
+    'secure,no_root_squash,no_all_squash)\n'
+    '/srv/world\n\t\t<world>(async,wdelay,nohide,insecure,root_squash,'
+    'all_squash,fsid=7,anonuid=1000,anongid=1000,sec=sys:krb5,ro,insecure,'
+    'root_squash,all_squash)\n')
+
+
+class ParseEtabTest(unittest.TestCase):
+
+    def test_parse(self):
+        exports = Export.parse_etab(ETAB)
+        self.assertEqual([(e.host, e.path) for e in exports],
+                         [('10.0.0.1', '/srv/share'),
+                          ('*', '/srv/with space'),
+                          ('host.example.com', '/srv/multi')])
+
+        share, space, multi = exports
+        # default values are left out
+        self.assertEqual(share.key_value_options, dict(sec='sys'))
+        self.assertEqual(share.options_list(), [
+            'secure', 'rw', 'sync', 'no_subtree_check', 'wdelay', 'hide',
+            'no_root_squash', 'no_all_squash', 'sec=sys'])
+        self.assertEqual(space.key_value_options, dict(
+            fsid='7', anonuid='1000', anongid='1000', sec='sys:krb5'))
+        self.assertTrue(space.options & Export.RO)
+        # the options of the second sec= flavor don't count
+        self.assertEqual(multi.key_value_options, dict(sec='sys'))
+        self.assertTrue(multi.options & Export.RW)
+        self.assertFalse(multi.options & Export.RO)
+        self.assertFalse(multi.options & Export.NO_ROOT_SQUASH)
+
+    def test_same_as_exportfs(self):
+        etab = Export.parse_etab(ETAB)[:2]
+        exportfs = Export.parse_exportfs_output(EXPORTFS_V)
+        self.assertEqual([(e.host, e.options_list()) for e in etab],
+                         [(e.host, e.options_list()) for e in exportfs])
+
+    def test_empty(self):
+        self.assertEqual(Export.parse_etab(''), [])
+
+
+class ParseExportsFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.file = os.path.join(self.dir, 'exports')
+        patcher = mock.patch.object(Export, '_parsed_files', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write(self, text, mtime_ns):
+        with open(self.file, 'w') as f:
+            f.write(text)
+        os.utime(self.file, ns=(mtime_ns, mtime_ns))
+
+    def _parse(self):
+        with mock.patch.object(Export, 'parse_export',
+                               wraps=Export.parse_export) as parse_export:
+            exports = Export.parse_exports_file(self.file)
+        return [(e.host, e.path) for e in exports], parse_export.called
+
+    def test_cached(self):
+        self._write('/srv/a a(rw)\n', 10 ** 18)
+        self.assertEqual(self._parse(), ([('a', '/srv/a')], True))
+        self.assertEqual(self._parse(), ([('a', '/srv/a')], False))
+
+        # callers get a copy of the cached list
+        Export.parse_exports_file(self.file).pop()
+        self.assertEqual(self._parse(), ([('a', '/srv/a')], False))
+
+    def test_mtime_changed(self):
+        self._write('/srv/a a(rw)\n', 10 ** 18)
+        self._parse()
+        # same size
+        self._write('/srv/b b(rw)\n', 10 ** 18 + 1)
+        self.assertEqual(self._parse(), ([('b', '/srv/b')], True))
+
+    def test_size_changed(self):
+        self._write('/srv/a a(rw)\n', 10 ** 18)
+        self._parse()
+        # same mtime, as a change within the file system's time granularity
+        self._write('/srv/a a(rw)\n/srv/b b(ro)\n', 10 ** 18)
+        self.assertEqual(self._parse(),
+                         ([('a', '/srv/a'), ('b', '/srv/b')], True))
+
+    def test_replaced(self):
+        self._write('/srv/a a(rw)\n', 10 ** 18)
+        self._parse()
+        # renamed over, same size and mtime, another inode
+        other = os.path.join(self.dir, 'other')
+        with open(other, 'w') as f:
+            f.write('/srv/b b(rw)\n')
+        os.utime(other, ns=(10 ** 18, 10 ** 18))
+        os.rename(other, self.file)
+        self.assertEqual(self._parse(), ([('b', '/srv/b')], True))
+
+
+class ExportTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.etab = os.path.join(self.dir, 'etab')
+
+        for name, value in (('ETAB', self.etab), ('_etab', None)):
+            patcher = mock.patch.object(Nfs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.commands = []
+        patcher = mock.patch.object(nfs, 'invoke', self.invoke)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def invoke(self, cmd, raise_exception=True, env=None):
+        self.commands.append(cmd)
+        return 0, EXPORTFS_V, ''
+
+    def _write_etab(self, text):
+        with open(self.etab, 'w') as f:
+            f.write(text)
+
+    def test_etab(self):
+        self._write_etab(ETAB)
+        table = Nfs.export_table()
+        self.assertEqual(list(table), [('10.0.0.1', '/srv/share'),
+                                       ('*', '/srv/with space'),
+                                       ('host.example.com', '/srv/multi')])
+        self.assertEqual(table[('*', '/srv/with space')].path,
+                         '/srv/with space')
+        self.assertEqual(self.commands, [])
+
+        # callers get a copy of the cached table
+        del table[('10.0.0.1', '/srv/share')]
+        self.assertIn(('10.0.0.1', '/srv/share'), Nfs.export_table())
+
+    def test_etab_changed(self):
+        self._write_etab(ETAB)
+        self.assertEqual(len(Nfs.export_table()), 3)
+
+        self._write_etab(ETAB.splitlines(True)[0])
+        self.assertEqual(list(Nfs.export_table()),
+                         [('10.0.0.1', '/srv/share')])
+
+    def test_exportfs_fallback(self):
+        table = Nfs.export_table()
+        self.assertEqual(self.commands, [[Nfs.CMD, '-v']])
+        self.assertEqual(list(table), [('10.0.0.1', '/srv/share'),
+                                       ('*', '/srv/world')])
+        self.assertEqual(table[('*', '/srv/world')].key_value_options, dict(
+            fsid='7', anonuid='1000', anongid='1000', sec='sys:krb5'))
+        self.assertEqual([e.path for e in Nfs.exports()],
+                         ['/srv/share', '/srv/world'])
+
+
+if __name__ == '__main__':
+    unittest.main()
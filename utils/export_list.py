@@ -35,16 +35,11 @@ import base64
 import json
 import os
 import re
-import socket
 import sys
 import time
 
-try:
-    from urllib.request import (Request,
-                                urlopen)
-except ImportError:
-    from urllib2 import (Request,
-                         urlopen)
+import targetd_rpc
+
 
 def jsonrequest(method, params=None):
     global id_num
@@ -56,22 +51,7 @@ def jsonrequest(method, params=None):
     headers = {'Content-Type': 'application/json',
                'Authorization': 'Basic %s' % (auth,)}
 
-    if ssl:
-        scheme = 'https'
-    else:
-        scheme = 'http'
-
-    url = "%s://%s:%s%s" % (scheme, host, port, path)
-    try:
-        request = Request(url, data.encode('utf-8'), headers)
-        response_obj = urlopen(request)
-    except socket.error as e:
-        print("error, retrying with SSL")
-        url = "https://%s:%s%s" % (host, port, path)
-        request = Request(url, data, headers)
-        response_obj = urlopen(request)
-
-    response_data = response_obj.read().decode('utf-8')
+    response_data = targetd_rpc.post(host, port, path, ssl, data, headers)
 
     response = json.loads(response_data)
     #Ensure we have version string
@@ -98,6 +78,10 @@ if __name__ == "__main__":
                       action = "store",
                       dest = "initiatorName",
                       default = None)
+  parser.add_argument('--name', help = "Only list out exports of the volume with this name",
+                      action = "store",
+                      dest = "name",
+                      default = None)
   parser.add_argument('--password', help = "Authentication with REST API: Password",
                       action = "store",
                       dest = "password",
@@ -124,6 +108,7 @@ if __name__ == "__main__":
   user = args.user
   list_all = args.list_all
   initiatorName = args.initiatorName
+  name = args.name
 
   # Configurables that really don't need to change
   id_num = 1
@@ -146,10 +131,12 @@ if __name__ == "__main__":
           break
 
   #XXX: Do we want to always list out all pools, or have multiple --all operations?
+  # Let targetd do the filtering instead of sending back every export
   if list_all:
-    results = jsonrequest("export_list")
+    results = jsonrequest("export_list", dict(name=name))
   else:
-    results = jsonrequest("export_list", dict(pool=pool, initiator_wwn=initiatorName))
+    results = jsonrequest("export_list", dict(pool=pool, initiator_wwn=initiatorName,
+                                              name=name))
   space_formatting="%-25s %-15s %-40s %-3s %-10s %s"
   print(space_formatting % ('vol_name',
                             'vol_size',
@@ -35,16 +35,11 @@ import base64
 import json
 import os
 import re
-import socket
 import sys
 import time
 
-try:
-    from urllib.request import (Request,
-                                urlopen)
-except ImportError:
-    from urllib2 import (Request,
-                         urlopen)
+import targetd_rpc
+
 
 def jsonrequest(method, params=None):
     global id_num
@@ -56,22 +51,7 @@ def jsonrequest(method, params=None):
     headers = {'Content-Type': 'application/json',
                'Authorization': 'Basic %s' % (auth,)}
 
-    if ssl:
-        scheme = 'https'
-    else:
-        scheme = 'http'
-
-    url = "%s://%s:%s%s" % (scheme, host, port, path)
-    try:
-        request = Request(url, data.encode('utf-8'), headers)
-        response_obj = urlopen(request)
-    except socket.error as e:
-        print("error, retrying with SSL")
-        url = "https://%s:%s%s" % (host, port, path)
-        request = Request(url, data, headers)
-        response_obj = urlopen(request)
-
-    response_data = response_obj.read().decode('utf-8')
+    response_data = targetd_rpc.post(host, port, path, ssl, data, headers)
 
     response = json.loads(response_data)
     # print('Got response: %s' % response_data)
@@ -35,16 +35,11 @@ import base64
 import json
 import os
 import re
-import socket
 import sys
 import time
 
-try:
-    from urllib.request import (Request,
-                                urlopen)
-except ImportError:
-    from urllib2 import (Request,
-                         urlopen)
+import targetd_rpc
+
 
 def jsonrequest(method, params=None):
     global id_num
@@ -56,22 +51,7 @@ def jsonrequest(method, params=None):
     headers = {'Content-Type': 'application/json',
                'Authorization': 'Basic %s' % (auth,)}
 
-    if ssl:
-        scheme = 'https'
-    else:
-        scheme = 'http'
-
-    url = "%s://%s:%s%s" % (scheme, host, port, path)
-    try:
-        request = Request(url, data.encode('utf-8'), headers)
-        response_obj = urlopen(request)
-    except socket.error as e:
-        print("error, retrying with SSL")
-        url = "https://%s:%s%s" % (host, port, path)
-        request = Request(url, data, headers)
-        response_obj = urlopen(request)
-
-    response_data = response_obj.read().decode('utf-8')
+    response_data = targetd_rpc.post(host, port, path, ssl, data, headers)
 
     response = json.loads(response_data)
     #print('Got response: %s' % response_data)
@@ -91,6 +71,10 @@ if __name__ == "__main__":
                       action = "store",
                       dest = "host",
                       default = '192.168.121.247')
+  parser.add_argument('--name', help = "Only list out the file system with this name",
+                      action = "store",
+                      dest = "name",
+                      default = None)
   parser.add_argument('--password', help = "Authentication with REST API: Password",
                       action = "store",
                       dest = "password",
@@ -115,16 +99,15 @@ if __name__ == "__main__":
   pool = args.pool
   port = args.port
   user = args.user
+  name = args.name
 
   # Configurables that really don't need to change
   id_num = 1
   path = '/targetrpc'
   ssl = False
 
-  if pool is None:
-    results = jsonrequest("filesys_list")
-  else:
-    results = jsonrequest("filesys_list", dict(pool=pool))
+  # Let targetd do the filtering instead of sending back every file system
+  results = jsonrequest("fs_list", dict(pool=pool, name=name))
 
   space_formatting="%-15s %-15s %-25s %s"
   print(space_formatting % ('Name',
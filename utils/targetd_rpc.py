@@ -0,0 +1,120 @@
+# based on code from git://github.com/openstack/nova.git
+# nova/volume/nexenta/jsonrpc.py
+#
+# Copyright 2011 Nexenta Systems, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2012, Andy Grover <agrover@redhat.com>
+#
+# HTTP transport of the client and the scripts in utils.
+#
+
+import socket
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException, \
+        RemoteDisconnected
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+
+    class RemoteDisconnected(HTTPException):
+        # not raised by python 2, which reports it as any bad status line
+        pass
+
+
+connection = None
+
+
+def _connect(host, port, use_ssl):
+    if use_ssl:
+        return HTTPSConnection(host, port)
+    return HTTPConnection(host, port)
+
+
+class _NotSent(Exception):
+    """
+    The request didn't reach the server, it can be sent again
+    """
+
+    def __init__(self, error):
+        Exception.__init__(self, str(error))
+        self.error = error
+
+
+def _send(conn, path, data, headers):
+    try:
+        conn.request('POST', path, data.encode('utf-8'), headers)
+    except (socket.error, HTTPException) as e:
+        # not sent in full, the server can't have run it
+        raise _NotSent(e)
+    try:
+        response_obj = conn.getresponse()
+    except RemoteDisconnected as e:
+        # closed without a byte of response: the server dropped the idle
+        # connection instead of reading the request
+        raise _NotSent(e)
+    response_data = response_obj.read().decode('utf-8')
+    if response_obj.status != 200:
+        raise Exception("HTTP error %d %s" % (response_obj.status,
+                                              response_obj.reason))
+    return response_data
+
+
+def post(host, port, path, use_ssl, data, headers):
+    """
+    POST data to path on host:port and return the response body.
+
+    All calls share one persistent HTTP/1.1 connection, a new one is only
+    opened when the server closed the previous one.  A call is only sent
+    again when it surely didn't reach the server.
+    """
+    global connection
+
+    if connection is not None and \
+            (connection.host, connection.port) != (host, int(port)):
+        connection.close()
+        connection = None
+
+    if connection is not None:
+        try:
+            return _send(connection, path, data, headers)
+        except _NotSent:
+            # The server closed the idle connection
+            connection.close()
+        except (socket.error, HTTPException):
+            # The call may have run, sending it again could run it twice
+            connection.close()
+            connection = None
+            raise
+
+    try:
+        connection = _connect(host, port, use_ssl)
+        return _send(connection, path, data, headers)
+    except _NotSent as e:
+        if not isinstance(e.error, socket.error):
+            raise e.error
+        print("error, retrying with SSL")
+        connection = _connect(host, port, True)
+        try:
+            return _send(connection, path, data, headers)
+        except _NotSent as e:
+            raise e.error